@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Generates the synthetic YAML corpus of the benchmark suite
+
+Usage:
+
+    python bench/corpus.py DIRECTORY [SCALE]
+
+Each corpus stresses one shape of YAML input, and is written as
+``DIRECTORY/NAME.yaml``. SCALE (default 1.0) multiplies the number of
+elements of each corpus. Contents only depend on SCALE, so runs on
+the same SCALE can be compared.
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+
+def deep(size):
+    """Mappings nested ``size`` levels deep, with a sibling at each level"""
+    lines = []
+    for level in range(size):
+        indent = "  " * level
+        lines.append("%ssibling: %d\n%snext:\n" % (indent, level, indent))
+    lines.append("%s  leaf: value\n" % ("  " * (size - 1)))
+    return "".join(lines)
+
+
+def wide(size):
+    """One mapping of ``size`` keys"""
+    return "".join("key_%d: value %d\n" % (i, i) for i in range(size))
+
+
+def long(size):
+    """One sequence of ``size`` small flow mappings"""
+    return "items:\n" + "".join(
+        "- {name: item-%d, value: %d, tags: [a, b]}\n" % (i, i)
+        for i in range(size))
+
+
+def mappings(size):
+    """A sequence of ``size`` small flow mappings, as the whole document"""
+    return "".join("- {name: item-%d, value: %d, kind: x}\n" % (i, i)
+                   for i in range(size))
+
+
+def tags(size):
+    """One sequence of ``size`` values of custom tags"""
+    return "".join("- !secret value-%d\n- !ref {id: %d}\n" % (i, i)
+                   for i in range(size // 2))
+
+
+def anchors(size):
+    """``size`` mappings merging shared anchored mappings"""
+    head = ("defaults: &defaults {timeout: 30, retries: 3}\n"
+            "base: &base {<<: *defaults, user: nobody}\n"
+            "services:\n")
+    return head + "".join(
+        "  svc_%d:\n    <<: *base\n    port: %d\n" % (i, 1000 + i)
+        for i in range(size))
+
+
+def multidoc(size):
+    """A stream of ``size`` small documents"""
+    return "".join("---\nname: doc-%d\nvalue: %d\nlist: [1, 2]\n" % (i, i)
+                   for i in range(size))
+
+
+## name: (generator, number of elements at scale 1.0)
+CORPUS = {
+    "deep": (deep, 300),
+    "wide": (wide, 20000),
+    "long": (long, 10000),
+    "mappings": (mappings, 20000),
+    "tags": (tags, 20000),
+    "anchors": (anchors, 5000),
+    "multidoc": (multidoc, 5000),
+}
+
+
+def generate(directory, scale=1.0):
+    """Writes the corpus in ``directory``, returns the paths by name"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = {}
+    for name, (generator, size) in sorted(CORPUS.items()):
+        paths[name] = os.path.join(directory, "%s.yaml" % name)
+        with open(paths[name], "w") as f:
+            f.write(generator(max(1, int(size * scale))))
+    return paths
+
+
+if __name__ == "__main__":
+    if not 2 <= len(sys.argv) <= 3:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+    for name, path in sorted(generate(*sys.argv[1:2] + [
+            float(arg) for arg in sys.argv[2:]]).items()):
+        print("%-10s %s (%d bytes)" % (name, path, os.path.getsize(path)))
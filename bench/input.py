@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Compares reading a big YAML file piped on stdin, or as a file
+
+Usage:
+
+    python bench/input.py [SIZE_MB]
+
+A sequence of SIZE_MB megabytes (default 200) is generated in a
+temporary file, and its length is queried with ``--stream`` (so that
+memory use doesn't depend on the parsed content) on both PyYAML
+backends. Wall time and peak RSS of each ``shyaml`` process are
+reported. Only ``-f FILE`` is memory mapped, stdin is read as text
+even when redirected from the file.
+
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SHYAML = os.path.join(HERE, os.pardir, "shyaml.py")
+
+
+def generate(path, size):
+    line = "- {name: item, value: 1234567, tags: [a, b, c]}\n"
+    with open(path, "w") as f:
+        for _ in range(size // len(line)):
+            f.write(line)
+
+
+def run(cmd, stdin=None, env=None):
+    """Returns wall time and peak RSS (in MiB) of ``cmd``"""
+    start = time.time()
+    proc = subprocess.Popen(cmd, shell=True, stdin=stdin, env=env,
+                            stdout=open(os.devnull, "w"))
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - start
+    if status:
+        raise SystemExit("%r failed" % cmd)
+    return elapsed, rusage.ru_maxrss / 1024.0
+
+
+def main(size_mb=200):
+    fd, path = tempfile.mkstemp(suffix=".yaml")
+    os.close(fd)
+    try:
+        generate(path, size_mb * 1024 * 1024)
+        query = "%s %s --stream get-length" % (sys.executable, SHYAML)
+        cases = [
+            ("pipe", "cat %s | %s" % (path, query)),
+            ("< FILE", "%s < %s" % (query, path)),
+            ("-f FILE", "%s -f %s" % (query, path)),
+        ]
+        for backend, force in (("libyaml", ""), ("python", "1")):
+            env = dict(os.environ, FORCE_PYTHON_YAML_IMPLEMENTATION=force)
+            for label, cmd in cases:
+                elapsed, rss = run(cmd, env=env)
+                print("%-8s %-8s %8.2fs %8.1f MiB" % (backend, label,
+                                                      elapsed, rss))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""Times and memory-profiles shyaml actions on the synthetic corpus
+
+Usage:
+
+    python bench/run.py [-o RESULTS] [--scale SCALE] [--repeat N]
+                        [--backend {libyaml,python}] [--mode {lib,cli}]
+                        [--corpus NAME]
+    python bench/run.py --compare OLD NEW
+
+Each case (an action and a key on one corpus of ``bench/corpus.py``)
+is measured on both PyYAML backends, through the library API
+(``shyaml.do(..)``) and through the command line. Every measure is
+taken in a fresh process, as the backend is chosen at first load:
+
+- ``lib``: best time of N calls to ``do(..)``, and peak memory traced
+  by ``tracemalloc`` during one more call.
+- ``cli``: best wall time of N ``shyaml -f FILE ACTION KEY`` runs
+  (startup included), and their biggest peak RSS.
+
+Results are written as JSON to RESULTS (default ``bench-results.json``)
+along with the versions involved, and ``--compare`` prints the ratios
+between two of these files.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, os.pardir)
+SHYAML = os.path.join(ROOT, "shyaml.py")
+
+sys.path.insert(0, HERE)
+
+import corpus  ## noqa: E402
+
+BACKENDS = {"libyaml": "", "python": "1"}
+MODES = ("lib", "cli")
+
+
+def deep_path(scale):
+    size = max(1, int(corpus.CORPUS["deep"][1] * scale))
+    return ".".join(["next"] * size + ["leaf"])
+
+
+def cases(scale):
+    """Returns ``(corpus, action, key)`` of the benchmarked cases"""
+    return [
+        ("deep", "get-value", deep_path(scale)),
+        ("deep", "get-type", None),
+        ("wide", "keys", None),
+        ("wide", "values", None),
+        ("wide", "get-value", "key_10"),
+        ("long", "get-length", "items"),
+        ("long", "get-values", "items"),
+        ("long", "get-value", "items.-1.name"),
+        ("mappings", "get-length", None),
+        ("tags", "get-length", None),
+        ("tags", "get-value", None),
+        ("anchors", "get-value", "services"),
+        ("anchors", "get-value", "services.svc_0.timeout"),
+        ("multidoc", "get-value", "name"),
+        ("multidoc", "get-value", None),
+    ]
+
+
+def measure_lib(path, action, key, repeat):
+    import tracemalloc
+
+    sys.path.insert(0, ROOT)
+    import shyaml
+
+    def call():
+        with open(path, "rb") as f:
+            for _ in shyaml.do(f, action, key, dump=shyaml.magic_dump):
+                pass
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        call()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time": best, "memory": peak,
+            "libyaml": bool(shyaml.__with_libyaml__)}
+
+
+def measure_cli(path, action, key, repeat):
+    cmd = [sys.executable, SHYAML, "-f", path, action] + \
+        ([] if key is None else [key])
+    best, memory = None, 0
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            proc = subprocess.Popen(cmd, stdout=devnull)
+            _, status, rusage = os.wait4(proc.pid, 0)
+            elapsed = time.time() - start
+            if status:
+                raise SystemExit("%r failed" % (cmd, ))
+            best = elapsed if best is None else min(best, elapsed)
+            memory = max(memory, rusage.ru_maxrss * 1024)
+    return {"time": best, "memory": memory}
+
+
+def worker(mode, path, action, key, repeat):
+    """Prints the JSON measure of a case, run with its own backend"""
+    key = None if key == "-" else key
+    measure = measure_lib if mode == "lib" else measure_cli
+    print(json.dumps(measure(path, action, key, int(repeat))))
+
+
+def versions():
+    import yaml
+    try:
+        commit = subprocess.check_output(
+            ["git", "-C", ROOT, "rev-parse", "HEAD"],
+            stderr=open(os.devnull, "w")).decode("ascii").strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+    return {"python": platform.python_version(),
+            "pyyaml": yaml.__version__,
+            "platform": platform.platform(),
+            "commit": commit,
+            "date": datetime.datetime.now().isoformat()}
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix="shyaml-bench-")
+    paths = corpus.generate(directory, args.scale)
+    results = []
+    try:
+        for name, action, key in cases(args.scale):
+            if args.corpus and name not in args.corpus:
+                continue
+            for backend in args.backend or sorted(BACKENDS):
+                for mode in args.mode or MODES:
+                    env = dict(os.environ,
+                               FORCE_PYTHON_YAML_IMPLEMENTATION=BACKENDS[
+                                   backend])
+                    output = subprocess.check_output(
+                        [sys.executable, __file__, "--worker", mode,
+                         paths[name], action, "-" if key is None else key,
+                         str(args.repeat)], env=env)
+                    result = dict(json.loads(output.decode("utf-8")),
+                                  corpus=name, action=action, key=key,
+                                  backend=backend, mode=mode)
+                    results.append(result)
+                    print("%-9s %-10s %-25.25s %-7s %-3s %8.3fs %8.1f MiB"
+                          % (name, action, key or "", backend, mode,
+                             result["time"], result["memory"] / 1048576.0))
+                    sys.stdout.flush()
+    finally:
+        for path in paths.values():
+            os.unlink(path)
+        os.rmdir(directory)
+    with open(args.output, "w") as f:
+        json.dump({"versions": versions(), "scale": args.scale,
+                   "repeat": args.repeat, "results": results},
+                  f, indent=2, sort_keys=True)
+    print("Results written to %r" % args.output)
+
+
+def compare(old_path, new_path):
+    """Prints time and memory ratios of results ``new`` over ``old``"""
+    def load(path):
+        with open(path) as f:
+            data = json.load(f)
+        return dict(((r["corpus"], r["action"], r["key"], r["backend"],
+                      r["mode"]), r) for r in data["results"])
+    old, new = load(old_path), load(new_path)
+    for case in sorted(set(old) & set(new), key=str):
+        print("%-9s %-10s %-25.25s %-7s %-3s time x%.2f  memory x%.2f"
+              % (case[:2] + (case[2] or "", ) + case[3:] + (
+                  new[case]["time"] / max(old[case]["time"], 1e-9),
+                  float(new[case]["memory"]) / max(old[case]["memory"], 1))))
+
+
+def main():
+    if sys.argv[1:2] == ["--worker"]:
+        return worker(*sys.argv[2:])
+    parser = argparse.ArgumentParser(
+        description="shyaml benchmark suite, see module docstring.")
+    parser.add_argument("-o", "--output", default="bench-results.json")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--backend", action="append",
+                        choices=sorted(BACKENDS))
+    parser.add_argument("--mode", action="append", choices=MODES)
+    parser.add_argument("--corpus", action="append",
+                        choices=sorted(corpus.CORPUS))
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+    if args.compare:
+        return compare(*args.compare)
+    return run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,10 +13,19 @@ from __future__ import print_function
 import sys
 import os.path
 import re
-import textwrap
 import locale
+import itertools
+import stat
+import struct
+import mmap
+import select
+import signal
+import time
+import base64
+from collections import deque
 
 import yaml
+from yaml.composer import Composer
 
 
 __version__ = "%%version%%"   ## gets filled at release time by ./autogen.sh
@@ -50,7 +59,10 @@ Usage:
 
     %(exname)s {-h|--help}
     %(exname)s {-V|--version}
-    %(exname)s [-y|--yaml] ACTION KEY [DEFAULT]
+    %(exname)s [-y|--yaml] [-q|--quiet] ACTION KEY [DEFAULT]
+    %(exname)s [-y|--yaml] [-q|--quiet] -e ACTION KEY [DEFAULT] [-e ...]
+    %(exname)s serve [SOCKET]
+    %(exname)s index FILE...
 """ % {"exname": EXNAME}
 
 HELP = """
@@ -69,6 +81,138 @@ Options:
               with safe literal value, then you don't need this.
               (Default: no safe YAML output)
 
+    --json
+              Output values as JSON, each on one line: results of
+              sequence and struct ACTIONs, and of each document of
+              a multi-document input, are given as JSON Lines.
+              Tagged values are written untagged, timestamps as
+              ISO 8601 strings, and 'get-type' output is unchanged.
+              (Default: YAML or raw output)
+
+    -q, --quiet
+              In case KEY value queried is an invalid path, quiet
+              mode will prevent the writing of an error message on
+              standard error.
+              (Default: no quiet mode)
+
+    -L, --line-buffer
+              Force parsing stdin as it is fed, allowing to process
+              streamed YAML document by document instead of
+              buffering input and treating several YAML streamed
+              document at once. With libyaml, all the input already
+              available is parsed at once, so that fast streams are
+              not read line by line.
+              (Default: no line buffering)
+
+    -f FILE, --file FILE
+              Read YAML from FILE instead of standard input. This
+              option can be repeated, the results on each FILE are
+              then terminated by a ``NUL`` char (so ``-0`` suffixed
+              ACTIONs are not supported), in the order of the FILEs.
+              An invalid path, or an unreadable or invalid FILE, is
+              reported without preventing the processing of the
+              next FILEs. With '--jobs N', N FILEs are parsed at
+              once.
+
+    --files0-from F
+              Read YAML from the FILEs listed in F, their names
+              being separated by ``NUL`` chars (as output by
+              ``find -print0``). If F is ``-``, the list is read from
+              standard input. Results are given as with several
+              '-f' options.
+
+    -H, --with-filename
+              Precede each result with the name of its FILE, also
+              terminated by a ``NUL`` char.
+              (Default: no filename)
+
+    --json-input
+              Parse the input with the much faster JSON parser, as
+              it is expected to be JSON (or JSON Lines, each line
+              being a document). If it isn't, it is parsed as YAML.
+              Can't be used with '-L'.
+              (Default: input is parsed as YAML)
+
+    --cache
+              Keep the parsed content of FILE in an on-disk cache,
+              so that next queries on the same unchanged FILE will
+              not need to parse it again. The cache is stored in
+              ``$SHYAML_CACHE_DIR`` (defaults to ``~/.cache/shyaml``)
+              and least recently used entries are removed when it
+              grows over ``$SHYAML_CACHE_SIZE`` bytes (defaults to
+              256 MiB). The cache is ignored if it is not owned by
+              you, or is writable by others.
+              (Default: no cache)
+
+    --socket SOCKET
+              Forward the query to a server launched with
+              ``serve`` and listening on SOCKET. The server keeps
+              the files it parsed in memory, so queries on the
+              same FILE are answered without parsing it again.
+              Only inputs given with ``-f`` are supported.
+
+    -1, --first-document
+              Only consider the first YAML document of the input
+              and stop reading it as soon as the result is known,
+              which makes querying keys located at the beginning
+              of big inputs fast. In this mode, the first
+              occurrence of duplicate keys wins. '-1' must be given
+              before ACTION, after it, it is a KEY or a DEFAULT.
+              (Default: all documents are read)
+
+    --doc SPEC
+              Only consider the documents of a multi-document input
+              selected by SPEC, a comma separated list of positions
+              (starting from 0, negative ones counting from the end)
+              and of python-like START:STOP:STEP ranges (as ``5:``
+              or ``::10``). Other documents are skipped without
+              being parsed, and the input isn't read further than
+              the last document that can be selected. Results are
+              given in the order of the input. If FILE has an up to
+              date index (written by '%(exname)s index FILE'), only
+              the texts of the selected documents are read. Can't
+              be used with '-1' or '--jobs'.
+              (Default: all documents are read)
+
+    --stream
+              Read the targeted sequence or struct one element at a
+              time, using a constant amount of memory whatever its
+              size. In this mode, the first occurrence of duplicate
+              keys wins, pairs merged with '<<' are given after the
+              other keys of their struct, and anchors shared between
+              elements are not kept in the output.
+              (Default: targeted value is read as a whole)
+
+    -j N, --jobs N
+              Process the documents of a multi-document input with N
+              processes (0 uses one per CPU). Outputs keep the order
+              of the documents. Ignored with '-1', and can't be used
+              with '-L'.
+              (Default: documents are processed one after the other)
+
+    --stats
+              Report on standard error the time spent starting up
+              (importing PyYAML included), loading documents (which
+              includes following KEY), following the KEYs of '-e'
+              queries, acting on values and writing outputs, the
+              bytes and documents read, the peak memory and whether
+              libyaml was used.
+              Setting ``$SHYAML_STATS`` has the same effect. With
+              '--jobs', time of worker processes counts as loading.
+              (Default: no stats)
+
+    --profile FILE
+              Run the query under ``cProfile`` and dump its stats to
+              FILE, to be read with the ``pstats`` module.
+
+    -e ACTION KEY [DEFAULT]
+              Add a query to answer from the same parsed input,
+              this option can be repeated. Each result will be
+              terminated by a ``NUL`` char, so ``-0`` suffixed
+              ACTIONs are not supported in this mode. A failing
+              query gets an empty result and its error on stderr,
+              the next queries are still answered (exit status 1).
+
     ACTION    Depending on the type of data you've targetted
               thanks to the KEY, ACTION can be:
 
@@ -100,6 +244,11 @@ Options:
               Use struct keyword to browse ``struct`` YAML data and use
               integers to browse ``sequence`` YAML data.
 
+              Use ``*`` to target all values of a struct or sequence,
+              and ``**`` to target a value and all values it holds at
+              any depth. The sequence of all matching values is then
+              the targeted value. Use ``\\*`` for a literal ``*``.
+
     DEFAULT   if not provided and given KEY do not match any value in
               the provided YAML, then DEFAULT will be returned. If no
               default is provided and the KEY do not match any value
@@ -117,6 +266,11 @@ Examples:
      ## get YAML config part of 'myhost'
      cat hosts_config.yaml | %(exname)s get-value cfgs.myhost
 
+     ## index a big stream of documents once, to then read only
+     ## its last document
+     %(exname)s index events.yaml
+     %(exname)s --doc -1 -f events.yaml get-value date
+
 """ % {"exname": EXNAME, "usage": USAGE}
 
 
@@ -129,15 +283,31 @@ class ShyamlSafeDumper(SafeDumper):
 
 
 ## Ugly way to force both the Cython code and the normal code
-## to get the output line by line.
+## to get the output as soon as it is available.
 class ForcedLineStream(object):
+    """Gives the parser ``fileobj`` line by line, so it doesn't wait
+
+    With ``available`` set, binary buffered files are rather read
+    with ``.read1(..)``, which only waits when nothing is buffered,
+    and returns what one read of the underlying file gives. On a pipe,
+    that is all the writer has written so far: documents are parsed
+    as soon as they are complete, but by big chunks when the writer
+    is fast. (The python parser needs another read after the end of
+    a document when given several lines at once, so is only given
+    lines.)
 
-    def __init__(self, fileobj):
+    """
+
+    def __init__(self, fileobj, available=False):
         self._file = fileobj
+        ## text files of python 3 have their binary file as ``.buffer``
+        self._read1 = getattr(getattr(fileobj, "buffer", fileobj),
+                              "read1", None) if available else None
 
     def read(self, size=-1):
-        ## don't care about size
-        return self._file.readline()
+        if self._read1 is None:
+            return self._file.readline()
+        return self._read1(size)  ## both parsers give a size
 
     def close(self):
         ## XXXvlab: for some reason, ``.close(..)`` doesn't seem to
@@ -149,7 +319,7 @@ class LineLoader(ShyamlSafeLoader):
     """Forcing stream in line buffer mode"""
 
     def __init__(self, stream):
-        stream = ForcedLineStream(stream)
+        stream = ForcedLineStream(stream, available=__with_libyaml__)
         super(LineLoader, self).__init__(stream)
 
 
@@ -168,8 +338,17 @@ except ImportError:  ## pragma: no cover
 
 ## Ensure that there are no collision with legacy OrderedDict
 ## that could be used for omap for instance.
-class MyOrderedDict(OrderedDict):
-    pass
+if sys.version_info >= (3, 7):
+
+    ## ``dict`` keeps insertion order, and takes about half the memory
+    ## of ``OrderedDict`` with its linked list
+    class MyOrderedDict(dict):
+        pass
+
+else:  ## pragma: no cover
+
+    class MyOrderedDict(OrderedDict):
+        pass
 
 
 ShyamlSafeDumper.add_representer(
@@ -181,7 +360,13 @@ def construct_omap(cls, node):
     ## Force unfolding reference and merges
     ## otherwise it would fail on 'merge'
     cls.flatten_mapping(node)
-    return MyOrderedDict(cls.construct_pairs(node))
+    pairs = cls.construct_pairs(node)
+    try:
+        return MyOrderedDict(pairs)
+    except TypeError:  ## as reported by PyYAML's ``construct_mapping``
+        raise yaml.constructor.ConstructorError(
+            "while constructing a mapping", node.start_mark,
+            "found unhashable key", node.start_mark)
 
 
 ShyamlSafeLoader.add_constructor(
@@ -196,18 +381,52 @@ ShyamlSafeLoader.add_constructor(
 class EncapsulatedNode(object):
     """Holds a yaml node"""
 
+    _node = None
+
+    def __reduce__(self):
+        ## Classes are created on the fly, so only the tag and the
+        ## base value are pickled. Note that the yaml node is lost.
+        return (unpickle_encapsulated_node,
+                (self.__class__.__name__,
+                 self.__class__.__bases__[0](self)))
+
+
+## Classes of tagged values by tag and base type, so that a class is
+## not created for each tagged node
+_encapsulated_classes = {}
+
+
+def encapsulated_class(tag, base):
+    """Returns the class of ``base`` values tagged with ``tag``
+
+        >>> cls = encapsulated_class("!secret", str)
+        >>> cls.__name__, cls is encapsulated_class("!secret", str)
+        ('!secret', True)
+
+    """
+    cls = _encapsulated_classes.get((tag, base))
+    if cls is None:
+
+        class _E(base, EncapsulatedNode):
+            pass
+
+        _E.__name__ = tag
+        cls = _encapsulated_classes[(tag, base)] = _E
+    return cls
+
+
+def unpickle_encapsulated_node(tag, data):
+    return encapsulated_class(tag, data.__class__)(data)
+
 
 def mk_encapsulated_node(s, node):
 
     method = "construct_%s" % (node.id, )
     data = getattr(s, method)(node)
 
-    class _E(data.__class__, EncapsulatedNode):
-        pass
-
-    _E.__name__ = str(node.tag)
-    _E._node = node
-    return _E(data)
+    value = encapsulated_class(str(node.tag), data.__class__)(data)
+    value._node = node
+    return value
 
 
 def represent_encapsulated_node(s, o):
@@ -260,16 +479,105 @@ def tokenize(s):
         >>> list(tokenize(None))
         []
 
+    Tokens made only of ``*`` or ``**`` are ``Wildcard`` instances, a
+    '\' is required to get them as literal keys:
+
+        >>> [type(t).__name__ for t in tokenize(r'a.*.**.\*.\*\*')]
+        ['str', 'Wildcard', 'Wildcard', 'str', 'str']
+        >>> list(tokenize(r'\*.\*\*'))
+        ['*', '**']
+
     """
     if s is None:
         return
-    tokens = (re.sub(r'\\(\\|\.)', r'\1', m.group(0))
+    if "\\" not in s:
+        for token in s.split("."):
+            yield WILDCARDS.get(token, token)
+        return
+
+    tokens = ((m.group(0), re.sub(r'\\(\\|\.|\*)', r'\1', m.group(0)))
               for m in re.finditer(r'((\\.|[^.\\])*)', s))
     ## an empty string superfluous token is added after all non-empty token
-    for token in tokens:
+    for raw, token in tokens:
         if len(token) != 0:
             next(tokens)
-        yield token
+        yield WILDCARDS.get(raw, token)
+
+
+class Wildcard(str):
+    """KEY token matching several values, see ``iter_matches(..)``"""
+
+
+WILDCARDS = dict((token, Wildcard(token)) for token in ("*", "**"))
+
+
+def as_index(token):
+    """Returns the integer value of ``token``, or ``None``
+
+        >>> as_index('-1'), as_index('a')
+        (-1, None)
+
+    """
+    try:
+        return int(token)
+    except (ValueError, TypeError):
+        return None
+
+
+class KeyPath(object):
+    r"""Parsed KEY, to follow in a structure with ``aget(..)``
+
+    Tokens are split once and integer indexes are resolved in
+    advance, in ``steps``:
+
+        >>> path = KeyPath(r'a.0.b\.c')
+        >>> path.tokens
+        ('a', '0', 'b.c')
+        >>> path.steps
+        (('a', None), ('0', 0), ('b.c', None))
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tokens = tuple(tokenize(path))
+        self.steps = tuple((token, as_index(token)) for token in self.tokens)
+
+    def __repr__(self):
+        return "<KeyPath %r>" % (self.path, )
+
+
+PATH_CACHE_SIZE = 512
+_path_cache = {}
+
+
+def compile_path(path):
+    """Returns the ``KeyPath`` of ``path``, memoized
+
+    Using the same KEY over and over is the common case, so parsed
+    paths are kept in a bounded cache:
+
+        >>> compile_path('a.b') is compile_path('a.b')
+        True
+        >>> compile_path(compile_path('a.b')).tokens
+        ('a', 'b')
+
+    """
+    if isinstance(path, KeyPath):
+        return path
+    try:
+        return _path_cache[path]
+    except KeyError:
+        pass
+    keypath = KeyPath(path)
+    if len(_path_cache) >= PATH_CACHE_SIZE:
+        ## Drop the oldest entry (an arbitrary one before python 3.7)
+        try:
+            del _path_cache[next(iter(_path_cache))]
+        except (KeyError, RuntimeError, StopIteration):  ## concurrent use
+            pass
+    _path_cache[path] = keypath
+    return keypath
 
 
 def mget(dct, key):
@@ -351,7 +659,7 @@ def mget(dct, key):
         {'a': 1}
 
     """
-    return aget(dct, tokenize(key))
+    return aget(dct, compile_path(key))
 
 
 class MissingKeyError(KeyError):
@@ -389,41 +697,120 @@ def aget(dct, key):
         >>> aget({'x': 1}, ())
         {'x': 1}
 
+    ``key`` can also be a ``KeyPath``, which spares the parsing of
+    integer indexes:
+
+        >>> aget({'a': [1, 5]}, compile_path('a.-1'))
+        5
+
+    With wildcards, the list of all matching values is returned:
+
+        >>> aget({'a': [{'x': 1}, {'y': 2}, {'x': 3}]}, compile_path('a.*.x'))
+        [1, 3]
+
     """
-    key = iter(key)
-    try:
-        head = next(key)
-    except StopIteration:
-        return dct
+    if isinstance(key, KeyPath):
+        steps = key.steps
+    else:
+        steps = tuple((head, as_index(head)) for head in key)
+    return follow_steps(dct, steps)
 
-    if isinstance(dct, list):
-        try:
-            idx = int(head)
-        except ValueError:
+
+def follow_steps(value, steps):
+    """Returns the value targeted by ``(token, index)`` pairs ``steps``
+
+    From the first ``Wildcard`` token, the list of all matching
+    values is returned instead.
+
+    """
+    for i, (head, idx) in enumerate(steps):
+        if isinstance(head, Wildcard):
+            return list(iter_matches(value, steps[i:]))
+        value = follow_step(value, head, idx)
+    return value
+
+
+def follow_step(value, head, idx):
+    if isinstance(value, list):
+        if idx is None:
             raise IndexNotIntegerError(
                 "non-integer index %r provided on a list."
                 % head)
         try:
-            value = dct[idx]
+            return value[idx]
         except IndexError:
-            raise IndexOutOfRange(
-                "index %d is out of range (%d elements in list)."
-                % (idx, len(dct)))
-    else:
+            raise out_of_range(idx, len(value))
+    try:
+        return value[head]
+    except KeyError:
+        ## Replace with a more informative KeyError
+        raise MissingKeyError(
+            "missing key %r in dict."
+            % (head, ))
+    except Exception:
+        raise NonDictLikeTypeError(
+            "can't query subvalue %r of a leaf%s."
+            % (head,
+               (" (leaf value is %r)" % value)
+               if len(repr(value)) < 15 else ""))
+
+
+def out_of_range(idx, count):
+    return IndexOutOfRange(
+        "index %d is out of range (%d elements in list)." % (idx, count))
+
+
+def iter_matches(value, steps):
+    """Yields all values targeted by ``steps``, wildcards included
+
+    A ``*`` token matches any value held by a struct or a sequence,
+    and a ``**`` token matches a value and all values it holds at any
+    depth. Values not matching the remaining steps are ignored:
+
+        >>> seq = [{'x': 1}, [{'x': 2}, 3], {'d': {'x': 4}}]
+        >>> list(iter_matches(seq, compile_path('*.x').steps))
+        [1]
+        >>> list(iter_matches(seq, compile_path('**.x').steps))
+        [1, 2, 4]
+        >>> list(iter_matches(seq, compile_path('1.*').steps))
+        [{'x': 2}, 3]
+
+    """
+    for i, (head, idx) in enumerate(steps):
+        if isinstance(head, Wildcard):
+            rest = steps[i + 1:]
+            for node in (descendants(value) if head == "**"
+                         else children(value)):
+                for match in iter_matches(node, rest):
+                    yield match
+            return
         try:
-            value = dct[head]
-        except KeyError:
-            ## Replace with a more informative KeyError
-            raise MissingKeyError(
-                "missing key %r in dict."
-                % (head, ))
-        except Exception:
-            raise NonDictLikeTypeError(
-                "can't query subvalue %r of a leaf%s."
-                % (head,
-                   (" (leaf value is %r)" % dct)
-                   if len(repr(dct)) < 15 else ""))
-    return aget(value, key)
+            value = follow_step(value, head, idx)
+        except PATH_ERRORS:
+            return
+    yield value
+
+
+def children(value):
+    """Returns the list of values held by a struct or a sequence"""
+    if isinstance(value, dict):
+        return list(value.values())
+    if isinstance(value, list):
+        return value
+    return []
+
+
+def descendants(value):
+    """Yields ``value`` and all values it holds, depth first"""
+    stack = [(value, ())]
+    while stack:
+        value, ancestors = stack.pop()
+        yield value
+        if id(value) in ancestors:  ## recursive structure
+            continue
+        ancestors += (id(value), )
+        stack.extend((child, ancestors)
+                     for child in reversed(children(value)))
 
 
 def stderr(msg):
@@ -446,8 +833,10 @@ SIMPLE_TYPES = (str if PY3 else basestring, int, float, type(None))
 COMPLEX_TYPES = (list, dict)
 if PY3:
     STRING_TYPES = (str, )
+    INTEGER_TYPES = (int, )
 else:
     STRING_TYPES = (unicode, str)
+    INTEGER_TYPES = (int, long)
 
 ## these are not composite values
 ACTION_SUPPORTING_STREAMING=["get-type", "get-length", "get-value"]
@@ -470,15 +859,154 @@ def yaml_dump(value):
     Literal types are quoted and safe to use as YAML.
 
     """
+    dumped = dump_scalar(value)
+    if dumped is not None:
+        return dumped
     return yaml.dump(value, default_flow_style=False,
                      Dumper=ShyamlSafeDumper)
 
 
+json_encode = None  ## set on first use, as importing ``json`` is slow
+
+
+def json_dump(value):
+    r"""Returns a one line JSON representation of ``value``
+
+    Order of structs is kept, and tagged values are written as their
+    untagged value. Timestamps are written as ISO 8601 strings, binary
+    data as base64 strings and sets as sequences:
+
+        >>> import datetime
+        >>> print(json_dump(MyOrderedDict([("b", datetime.date(2001, 1, 2)),
+        ...                                ("a", [1, None, True])])))
+        {"b":"2001-01-02","a":[1,null,true]}
+
+    Sets are written sorted, so the output doesn't depend on the hash
+    of their elements:
+
+        >>> print(json_dump({"b", "c", "a"}))
+        ["a","b","c"]
+
+    Struct keys can only be strings, numbers, booleans or null, and
+    infinite and NaN floats, as recursive values, have no JSON
+    equivalent:
+
+        >>> key = datetime.date(2001, 1, 2)
+        >>> json_dump({key: 1})  ## doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        InvalidOutput: struct key of type 'date' can't be written as JSON.
+        >>> json_dump([float("inf")])  ## doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        InvalidOutput: infinite and NaN floats can't be written as JSON.
+
+    """
+    global json_encode  ## pylint: disable=global-statement
+    if json_encode is None:
+        import json
+
+        json_encode = json.JSONEncoder(
+            ensure_ascii=False, separators=(",", ":"), allow_nan=False,
+            default=json_default).encode
+    try:
+        return json_encode(value)
+    except TypeError:  ## only raised for keys, see ``json_default(..)``
+        raise InvalidOutput("struct key of type %r can't be written as JSON."
+                            % json_bad_key(value))
+    except ValueError as e:
+        raise InvalidOutput(
+            "recursive values can't be written as JSON."
+            if "ircular" in str(e) else
+            "infinite and NaN floats can't be written as JSON.")
+
+
+def json_bad_key(value):
+    """Returns the type name of the first key of ``value`` JSON rejects"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not isinstance(key, STRING_TYPES + INTEGER_TYPES +
+                              (float, type(None))):
+                return type_name(key)
+            name = json_bad_key(item)
+            if name is not None:
+                return name
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            name = json_bad_key(item)
+            if name is not None:
+                return name
+    return None
+
+
+def json_default(value):
+    """Returns a JSON serializable equivalent of ``value``"""
+    if hasattr(value, "isoformat"):  ## date and datetime
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, (set, frozenset)):
+        try:
+            return sorted(value)
+        except TypeError:  ## elements of different types
+            return sorted(value, key=lambda element: (
+                type(element).__name__, repr(element)))
+    raise InvalidOutput("value of type %r can't be written as JSON."
+                        % type_name(value))
+
+
+## Texts that are always written as-is by the emitter: no indicator
+## at start, no char needing quotes, no space to fold lines on.
+PLAIN_TEXT_PATTERN = r"[A-Za-z0-9_][A-Za-z0-9_./-]*\Z"
+STR_TAG = "tag:yaml.org,2002:str"
+FLOAT_TAG = "tag:yaml.org,2002:float"
+
+## Used by ``dump_scalar(..)`` to resolve implicit types as the
+## dumper would, and to spot texts needing no quotes. The end of
+## plain scalars documents depends on the emitter ("..." or not).
+scalar_dumper = ShyamlSafeDumper(None)
+scalar_end = yaml.dump("a", Dumper=ShyamlSafeDumper)[1:]
+plain_text = re.compile(PLAIN_TEXT_PATTERN).match
+
+
+def dump_scalar(value):
+    r"""Returns ``yaml_dump(value)`` of common scalars, ``None`` otherwise
+
+    This spares building a dumper, with its emitter and serializer,
+    for each key or value of big collections:
+
+        >>> [dump_scalar(v).split("\n")[0] for v in ("abc", -1, None)]
+        ['abc', '-1', 'null']
+
+    Strings that would be quoted, among which those read back as
+    another type, are left to the dumper:
+
+        >>> dump_scalar("a: b"), dump_scalar("true"), dump_scalar("1.0")
+        (None, None, None)
+
+    """
+    cls = type(value)
+    if cls in STRING_TYPES:
+        if not plain_text(value) or scalar_dumper.resolve(
+                yaml.ScalarNode, value, (True, False)) != STR_TAG:
+            return None
+        text = value
+    elif cls is bool:
+        text = "true" if value else "false"
+    elif cls in INTEGER_TYPES:
+        text = "%d" % value
+    elif value is None:
+        text = "null"
+    else:
+        return None
+    return text + scalar_end
+
+
 def type_name(value):
     """Returns pseudo-YAML type name of given value."""
     return type(value).__name__ if isinstance(value, EncapsulatedNode) else \
-           "struct" if isinstance(value, dict) else \
-           "sequence" if isinstance(value, (tuple, list)) else \
+           "struct" if isinstance(value, STRUCT_TYPES) else \
+           "sequence" if isinstance(value, SEQUENCE_TYPES + (tuple, )) else \
            "str" if isinstance(value, STRING_TYPES) else \
            type(value).__name__
 
@@ -497,27 +1025,155 @@ def get_version_info():
             )
 
 
-def _parse_args(args, USAGE, HELP):
-    opts = {}
+def pop_flag(args, names):
+    """Removes options ``names`` from ``args``, returns the last found
+
+        >>> args = ["-q", "get-value", "a", "--quiet"]
+        >>> pop_flag(args, ["-q", "--quiet"]), args
+        ('--quiet', ['get-value', 'a'])
+
+    """
+    found = None
+    for name in names:
+        while name in args:
+            args.remove(name)
+            found = name
+    return found
+
+
+def pop_option(args, names, metavar):
+    """Removes options ``names`` and their values from ``args``
+
+    Returns the ``(name, value)`` pairs found, in the order of
+    ``args``:
+
+        >>> args = ["-f", "a.yaml", "get-value", "--file", "b.yaml"]
+        >>> pop_option(args, ("-f", "--file"), "FILE"), args
+        ([('-f', 'a.yaml'), ('--file', 'b.yaml')], ['get-value'])
+
+    """
+    found = []
+    idx = 0
+    while idx < len(args):
+        name = args[idx]
+        if name not in names:
+            idx += 1
+            continue
+        if idx + 1 == len(args):
+            stderr("Error: Missing %s argument to '%s'.\n" % (metavar, name))
+            die(USAGE, errlvl=1, prefix="")
+        found.append((name, args[idx + 1]))
+        del args[idx:idx + 2]
+    return found
+
+
+def _parse_output_args(args, opts):
+    opts["dump"] = yaml_dump if pop_flag(args, ["-y", "--yaml"]) else \
+        magic_dump
+    if pop_flag(args, ["--json"]):
+        if opts["dump"] is yaml_dump:
+            die("'--json' can't be used with '-y'.")
+        opts["dump"] = json_dump
+    opts["quiet"] = bool(pop_flag(args, ["-q", "--quiet"]))
+
+
+def _parse_input_args(args, opts):
+    opts["json_input"] = bool(pop_flag(args, ["--json-input"]))
+    arg = pop_flag(args, ["-L", "--line-buffer"])
+    if arg:
+        if opts["json_input"]:
+            die("'--json-input' can't be used with '%s'." % arg)
+        opts["loader"] = LineLoader
+
+    ## '-f' can be repeated, order is kept
+    filenames = [value for _, value in
+                 pop_option(args, ("-f", "--file"), "FILE")]
+    if filenames:
+        opts["filenames"] = filenames
+    for _, value in pop_option(args, ("--files0-from", ), "F"):
+        opts["files0_from"] = value
+    opts["with_filename"] = bool(pop_flag(args, ["-H", "--with-filename"]))
 
-    opts["dump"] = magic_dump
-    for arg in ["-y", "--yaml"]:
-        if arg in args:
-            args.remove(arg)
-            opts["dump"] = yaml_dump
+    opts["cache"] = bool(pop_flag(args, ["--cache"]))
+    if opts["cache"] and "filenames" not in opts and \
+           "files0_from" not in opts:
+        die("'--cache' requires a FILE to be given with '-f'.")
 
-    opts["quiet"] = False
-    for arg in ["-q", "--quiet"]:
-        if arg in args:
-            args.remove(arg)
-            opts["quiet"] = True
 
-    for arg in ["-L", "--line-buffer"]:
+def _parse_reading_args(args, opts):
+    for _, spec in pop_option(args, ("--doc", ), "SPEC"):
+        try:
+            opts["documents"] = compile_documents(spec)
+        except ValueError:
+            die("Invalid '--doc' value %r, comma separated positions or "
+                "START:STOP:STEP ranges of documents are expected." % spec)
+
+    if pop_flag(args, ["--stream"]):
+        opts["streaming"] = True
+
+    for arg, jobs in pop_option(args, ("-j", "--jobs"), "N"):
+        if not jobs.isdigit():
+            die("Invalid '%s' value %r, a number of processes is expected."
+                % (arg, jobs))
+        if "loader" in opts:
+            die("'%s' can't be used with '-L'." % arg)
+        if "documents" in opts:
+            die("'%s' can't be used with '--doc'." % arg)
+        opts["jobs"] = int(jobs) or None  ## 0 is for the number of CPUs
+    _parse_first_arg(args, opts)
+
+
+def _parse_first_arg(args, opts):
+    ## '-1' is also a negative index in KEY, a DEFAULT or a '--doc'
+    ## position: it is only the option when given before ACTION (options
+    ## taking a value are already removed at this point)
+    for arg in ["-1", "--first-document"]:
         if arg not in args:
             continue
-        args.remove(arg)
+        idx = args.index(arg)
+        if arg == "-1" and any(not prev.startswith("-") or prev == "-e"
+                               for prev in args[:idx]):
+            continue
+        del args[idx]
+        if "documents" in opts:
+            die("'%s' can't be used with '--doc'." % arg)
+
+        opts["first"] = True
+
+
+def _parse_queries(args, opts):
+    """Moves the '-e' queries of ``args`` to ``opts``, if any"""
+    while "-e" in args:
+        idx = args.index("-e")
+        end = args.index("-e", idx + 1) if "-e" in args[idx + 1:] else \
+              len(args)
+        query = args[idx + 1:end]
+        del args[idx:end]
+        if not 1 <= len(query) <= 3:
+            stderr("Error: Bad number of arguments for '-e'.\n")
+            die(USAGE, errlvl=1, prefix="")
+        if query[0].endswith("-0"):
+            die("'%s' can't be used with '-e', as results are already "
+                "NUL terminated." % query[0])
+        opts.setdefault("queries", []).append(
+            tuple(query) + (None, ) * (3 - len(query)))
+
+    if "queries" in opts:
+        if opts.get("streaming"):
+            die("'--stream' can't be used with '-e'.")
+        if args:
+            stderr("Error: Bad number of arguments.\n")
+            die(USAGE, errlvl=1, prefix="")
 
-        opts["loader"] = LineLoader
+
+def _parse_args(args, USAGE, HELP):
+    opts = {}
+    _parse_output_args(args, opts)
+    _parse_input_args(args, opts)
+    _parse_reading_args(args, opts)
+    _parse_queries(args, opts)
+    if "queries" in opts:
+        return opts
 
     if len(args) == 0:
         stderr("Error: Bad number of arguments.\n")
@@ -551,259 +1207,2338 @@ class InvalidAction(KeyError):
     """Invalid Action"""
 
 
+class InvalidInput(Exception):
+    """Unreadable or unparsable input"""
+
+
+class InvalidOutput(Exception):
+    """Value that can't be written in the requested output format"""
+
+
+class MissingDocument(IndexError):
+    """Selected document position beyond the last document"""
+
+    def __init__(self, position, count):
+        super(MissingDocument, self).__init__(position, count)
+        self.position, self.count = position, count
+
+    def __str__(self):
+        return "missing document %d, there are only %d documents." \
+            % (self.position, self.count)
+
+
+MERGE_TAG = "tag:yaml.org,2002:merge"
+
+PATH_ERRORS = (IndexOutOfRange, MissingKeyError,
+               NonDictLikeTypeError, IndexNotIntegerError)
+
+
+def invalid_path(path, exc):
+    """Returns the ``InvalidPath`` exception to raise for ``exc``"""
+    msg = str(exc)
+    return InvalidPath(
+        "invalid path %r, %s"
+        % (path, msg.replace('list', 'sequence').replace('dict', 'struct')))
+
+
 def traverse(contents, path, default=None):
+    path = compile_path(path)
     try:
         try:
-            value = mget(contents, path)
+            value = aget(contents, path)
         except (IndexOutOfRange, MissingKeyError):
             if default is None:
                 raise
             value = default
-    except (IndexOutOfRange, MissingKeyError,
-            NonDictLikeTypeError, IndexNotIntegerError) as exc:
-        msg = str(exc)
-        raise InvalidPath(
-            "invalid path %r, %s"
-            % (path, msg.replace('list', 'sequence').replace('dict', 'struct')))
+    except PATH_ERRORS as exc:
+        raise invalid_path(path.path, exc)
     return value
 
 
-class ActionTypeError(Exception):
+##
+## Path-pruned loading
+##
 
-    def __init__(self, action, provided, expected):
-        self.action = action
-        self.provided = provided
-        self.expected = expected
+class PathComposerMixin(object):
+    """Follows a tokenized key through the parser events of a loader
 
-    def __str__(self):
-        return ("%s does not support %r type. "
-                "Please provide or select a %s."
-                % (self.action, self.provided,
-                   self.expected[0] if len(self.expected) == 1 else
-                   ("%s or %s" % (", ".join(self.expected[:-1]),
-                                  self.expected[-1]))))
+    Only the targeted node gets composed and constructed, sibling
+    subtrees are consumed at event level and thrown away. Anchored
+    nodes are composed nonetheless as later aliases could refer to
+    them.
 
+    With ``first`` set, the walk stops as soon as the targeted node
+    is consumed: the first occurrence of duplicate keys wins and the
+    remaining events of the document are left unread.
 
-def act(action, value, dump=yaml_dump):
-    tvalue = type_name(value)
-    ## Note: ``\n`` will be transformed by ``universal_newlines`` mecanism for
-    ## any platform
-    termination = "\0" if action.endswith("-0") else "\n"
+    With ``streaming`` set, the walk also stops at the first match,
+    and a targeted plain sequence or mapping is returned unread as a
+    ``Streamed`` instance.
 
-    if action == "get-value":
-        return "%s" % dump(value)
-    elif action in ("get-values", "get-values-0"):
-        if isinstance(value, dict):
-            return "".join("".join((dump(k), termination,
-                                    dump(v), termination))
-                           for k, v in value.items())
-        elif isinstance(value, list):
-            return "".join("".join((dump(l), termination))
-                           for l in value)
-        else:
-            raise ActionTypeError(
-                action, provided=tvalue, expected=["sequence", "struct"])
-    elif action == "get-type":
-        return tvalue
-    elif action == "get-length":
-        if isinstance(value, (dict, list)):
-            return len(value)
-        else:
-            raise ActionTypeError(
-                action, provided=tvalue, expected=["sequence", "struct"])
-    elif action in ("keys", "keys-0",
-                    "values", "values-0",
-                    "key-values", "key-values-0"):
-        if isinstance(value, dict):
-            method = value.keys if action.startswith("keys") else \
-                value.items if action.startswith("key-values") else \
-                value.values
-            output = (lambda x: termination.join("%s" % dump(e) for e in x)) \
-                if action.startswith("key-values") else \
-                dump
-            return "".join("".join((str(output(k)), termination)) for k in method())
-        else:
-            raise ActionTypeError(
-                action=action, provided=tvalue, expected=["struct"])
-    else:
-        raise InvalidAction(action)
+    """
 
+    def __init__(self, loader, first=False, streaming=False):
+        super(PathComposerMixin, self).__init__()
+        self.loader = loader
+        self.first = first or streaming
+        self.streaming = streaming
+        self.check_event = loader.check_event
+        self.peek_event = loader.peek_event
+        self.get_event = loader.get_event
+        self.resolve = loader.resolve
+        self.descend_resolver = loader.descend_resolver
+        self.ascend_resolver = loader.ascend_resolver
+
+    def build(self, node):
+        return self.loader.construct_object(node, deep=True)
+
+    def build_released(self, node):
+        """Returns the value of ``node``, forgetting constructed objects"""
+        value = self.build(node)
+        self.loader.constructed_objects = {}
+        self.loader.recursive_objects = {}
+        return value
+
+    def reset(self):
+        self.anchors = {}
+        self.loader.constructed_objects = {}
+        self.loader.recursive_objects = {}
+
+    def drain(self):
+        """Skips events left unread up to the end of the document"""
+        while not self.check_event(yaml.DocumentEndEvent):
+            self.get_event()
+
+    def skip_node(self):
+        depth = 0
+        while True:
+            event = self.peek_event()
+            if getattr(event, "anchor", None) is not None and \
+                   not isinstance(event, yaml.AliasEvent):
+                self.compose_node(None, None)
+            else:
+                self.get_event()
+                if isinstance(event, yaml.CollectionStartEvent):
+                    depth += 1
+                elif isinstance(event, yaml.CollectionEndEvent):
+                    depth -= 1
+            if depth == 0:
+                return
+
+    def skip_items(self, end_event):
+        while not self.check_event(end_event):
+            self.skip_node()
+        self.get_event()
+
+    def walk_node(self, steps):
+        """Returns the value targeted by ``steps`` in next node
+
+        All events of the node are consumed, even when raising
+        one of the ``PATH_ERRORS`` exceptions, unless in ``first``
+        mode.
+
+        """
+        if not steps and not self.streaming:
+            return self.build(self.compose_node(None, None))
+        if steps and isinstance(steps[0][0], Wildcard):
+            ## Fanning out: the whole node is needed
+            return follow_steps(self.build(self.compose_node(None, None)),
+                                steps)
+        event = self.peek_event()
+        if event.anchor is None:
+            if isinstance(event, yaml.MappingStartEvent) and \
+                   self.event_tag(event, yaml.MappingNode) == \
+                   yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG:
+                if not steps:
+                    return StreamedStruct(self)
+                return self.walk_mapping(steps[0], steps[1:])
+            if isinstance(event, yaml.SequenceStartEvent) and \
+                   self.event_tag(event, yaml.SequenceNode) == \
+                   yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG:
+                if not steps:
+                    return StreamedSequence(self)
+                return self.walk_sequence(steps[0], steps[1:])
+        ## aliases, anchored, tagged and leaf nodes
+        return follow_steps(self.build(self.compose_node(None, None)), steps)
+
+    def event_tag(self, event, kind):
+        tag = event.tag
+        if tag is None or tag == "!":
+            tag = self.resolve(kind, None, event.implicit)
+        return tag
+
+    def walk_mapping(self, step, steps):
+        head = step[0]
+        self.get_event()
+        outcome, merges = None, []
+        while not self.check_event(yaml.MappingEndEvent):
+            key_node = self.compose_node(None, None)
+            if key_node.tag == MERGE_TAG:
+                merges.append((key_node, self.compose_node(None, None)))
+            elif self.build(key_node) != head:
+                self.skip_node()
+            elif self.first:
+                return self.walk_node(steps)
+            else:
+                ## Last duplicate key wins, as in ``construct_omap``
+                outcome = self.walk_outcome(steps)
+        self.get_event()
+        if outcome is not None:
+            return self.outcome_value(outcome)
+        return self.walk_merges(merges, head, steps)
+
+    def walk_merges(self, merges, head, steps):
+        """Returns the value targeted by ``steps`` in merged key ``head``"""
+        if merges:
+            node = yaml.MappingNode(
+                yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, merges)
+            self.loader.flatten_mapping(node)
+            nodes = [v for k, v in node.value if self.build(k) == head]
+            if nodes:
+                return follow_steps(self.build(nodes[-1]), steps)
+        raise MissingKeyError("missing key %r in dict." % (head, ))
+
+    def walk_sequence(self, step, steps):
+        head, idx = step
+        self.get_event()
+        if idx is None:
+            self.skip_items(yaml.SequenceEndEvent)
+            raise IndexNotIntegerError(
+                "non-integer index %r provided on a list."
+                % head)
+        if idx < 0:
+            return self.walk_last_items(idx, steps)
+        outcome, count = None, 0
+        while not self.check_event(yaml.SequenceEndEvent):
+            if count != idx:
+                self.skip_node()
+            elif self.first:
+                return self.walk_node(steps)
+            else:
+                outcome = self.walk_outcome(steps)
+            count += 1
+        self.get_event()
+        if outcome is None:
+            raise out_of_range(idx, count)
+        return self.outcome_value(outcome)
+
+    def walk_last_items(self, idx, steps):
+        """Returns the value targeted by ``steps`` in item ``idx`` (< 0)"""
+        ## Length is unknown until the end, so keep only composed
+        ## nodes of the last elements.
+        last, count = deque(maxlen=-idx), 0
+        while not self.check_event(yaml.SequenceEndEvent):
+            last.append(self.compose_node(None, None))
+            count += 1
+        self.get_event()
+        if count < -idx:
+            raise out_of_range(idx, count)
+        return follow_steps(self.build(last[0]), steps)
+
+    def walk_outcome(self, steps):
+        """Returns ``(value, error)`` of ``walk_node(steps)``
+
+        Path errors are kept to be raised once the events of the
+        whole collection are consumed.
+
+        """
+        try:
+            return self.walk_node(steps), None
+        except PATH_ERRORS as exc:
+            return None, exc
 
-def do(stream, action, key, default=None, dump=yaml_dump,
-       loader=ShyamlSafeLoader):
-    """Return string representations of target value in stream YAML
+    @staticmethod
+    def outcome_value(outcome):
+        value, error = outcome
+        if error is not None:
+            raise error
+        return value
 
-    The key is used for traversal of the YAML structure to target
-    the value that will be dumped.
 
-    :param stream:  file like input yaml content
-    :param action:  string identifying one of the possible supported actions
-    :param key:     string dotted expression to traverse yaml input
-    :param default: optional default value in case of missing end value when
-                    traversing input yaml.  (default is ``None``)
-    :param dump:    callable that will be given python objet to dump in yaml
-                    (default is ``yaml_dump``)
-    :param loader:  PyYAML's *Loader subclass to parse YAML
-                    (default is ShyamlSafeLoader)
-    :return:        generator of string representation of target value per
-                    YAML docs in the given stream.
+class PathComposer(PathComposerMixin, Composer):
+    __doc__ = PathComposerMixin.__doc__
 
-    :raises ActionTypeError: when there's a type mismatch between the
-        action selected and the type of the targetted value.
-        (ie: action 'key-values' on non-struct)
-    :raises InvalidAction: when selected action is not a recognised valid
-        action identifier.
-    :raises InvalidPath: upon inexistent content when traversing YAML
-        input following the key specification.
+
+class Streamed(object):
+    """Sequence or struct read element by element from the parser
+
+    Elements are composed, constructed and handed over one at a time
+    while iterating, so memory usage doesn't depend on their number.
+    They can only be iterated once, before the parser moves on to the
+    next document.
+
+    """
+
+    def __init__(self, composer):
+        self.composer = composer
+        self.consumed = False
+
+    def nodes(self, end_event):
+        if self.consumed:
+            raise ValueError("streamed %s can only be iterated once."
+                             % type_name(self))
+        self.consumed = True
+        composer = self.composer
+        composer.get_event()  ## CollectionStartEvent
+        while not composer.check_event(end_event):
+            yield composer.compose_node(None, None)
+        composer.get_event()
+
+    def dump_chunks(self, dump):
+        """Yields the dump of the whole value, element by element"""
+        if dump is json_dump:
+            ## JSON containers can't be concatenated as YAML blocks
+            brackets = dump(self.container())
+            separator = brackets[0]
+            for element in self.elements():
+                yield separator + dump(self.container([element]))[1:-1]
+                separator = ","
+            yield brackets if separator == brackets[0] else brackets[1]
+            return
+        empty = True
+        for element in self.elements():
+            empty = False
+            yield dump(self.container([element]))
+        if empty:
+            yield dump(self.container([]))
+
+
+class StreamedSequence(Streamed):
+
+    container = list
+
+    def __iter__(self):
+        for node in self.nodes(yaml.SequenceEndEvent):
+            yield self.composer.build_released(node)
+
+    elements = __iter__
+
+    def count(self):
+        """Returns the number of elements, consuming them"""
+        return sum(1 for _ in self.nodes(yaml.SequenceEndEvent))
+
+
+class StreamedStruct(Streamed):
+
+    container = MyOrderedDict
+
+    def key_pairs(self):
+        """Yields ``(key, value_node)`` of the pairs the struct holds
+
+        The first occurrence of duplicate keys wins. Pairs merged with
+        ``<<`` are overridden by explicit keys, so they are only given
+        once the whole mapping is read, after the explicit keys. Keys
+        already given are remembered.
+
+        """
+        build = self.composer.build_released
+        seen, merged = set(), MyOrderedDict()
+        nodes = self.nodes(yaml.MappingEndEvent)
+        for key_node in nodes:
+            value_node = next(nodes)
+            if key_node.tag == MERGE_TAG:
+                node = yaml.MappingNode(
+                    yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+                    [(key_node, value_node)])
+                self.composer.loader.flatten_mapping(node)
+                for merged_key_node, merged_value_node in node.value:
+                    ## as in a ``dict``, the last merged pair wins
+                    key = self.hashable(build(merged_key_node),
+                                        merged_key_node)
+                    merged[key] = merged_value_node
+                continue
+            key = self.hashable(build(key_node), key_node)
+            if key not in seen:
+                seen.add(key)
+                yield key, value_node
+        for key, value_node in merged.items():
+            if key not in seen:
+                yield key, value_node
+
+    @staticmethod
+    def hashable(key, key_node):
+        try:
+            hash(key)
+        except TypeError:
+            raise yaml.constructor.ConstructorError(
+                "while constructing a mapping", None,
+                "found unhashable key", key_node.start_mark)
+        return key
+
+    def items(self):
+        build = self.composer.build_released
+        for key, value_node in self.key_pairs():
+            yield key, build(value_node)
+
+    elements = items
+
+    def keys(self):
+        for key, _ in self.key_pairs():
+            yield key
+
+    __iter__ = keys
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+    def count(self):
+        """Returns the number of pairs, consuming them"""
+        return sum(1 for _ in self.key_pairs())
+
+
+STRUCT_TYPES = (dict, StreamedStruct)
+SEQUENCE_TYPES = (list, StreamedSequence)
+
+
+def traverse_all(stream, path, default=None, loader=None, first=False,
+                 streaming=False, documents=None):
+    r"""Yields target value of ``path`` in each YAML document of ``stream``
+
+    This is equivalent to calling ``traverse(..)`` on each document
+    of ``yaml.load_all(..)``, except that for keys of several steps
+    (see ``prunes(..)``), only the targeted value is constructed as
+    python object:
+
+        >>> stream = '''
+        ... a: &base {x: 1, y: [1, 2, 3]}
+        ... b:
+        ...   <<: *base
+        ...   y: [4, 5]
+        ... ---
+        ... b: {x: 2}
+        ... b: {y: [6]}
+        ... '''
+        >>> list(traverse_all(stream, 'b.y.-1', default='none'))
+        [5, 6]
+        >>> list(traverse_all(stream, 'b.x', default='none'))
+        [1, 'none']
+        >>> list(traverse_all(stream, 'b.x'))
+        ... ## doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        InvalidPath: invalid path 'b.x', missing key 'x' in struct.
+
+    ``stream`` can also be a ``LoadedDocuments`` instance, in which
+    case no parsing is involved, or a ``DocumentSlices`` instance.
+
+    Empty streams are considered as one document holding ``null``:
+
+        >>> list(traverse_all('', None))
+        [None]
+
+    With ``first`` set, only the first document is considered and
+    reading of ``stream`` stops as soon as the targeted value is
+    parsed:
+
+        >>> list(traverse_all(stream, 'b.x', first=True))
+        [1]
+        >>> list(traverse_all('a: 1\nb: [', 'a', first=True))
+        [1]
+
+    With ``streaming`` set, the first occurrence of duplicate keys
+    wins and targeted plain sequences and structs are yielded as
+    ``Streamed`` instances, to be consumed before asking for the next
+    document:
+
+        >>> for value in traverse_all('a: [1, 2]\n---\na: {x: 3}', 'a',
+        ...                           streaming=True):
+        ...     print("%s: %r" % (type_name(value), list(value)))
+        sequence: [1, 2]
+        struct: ['x']
+
+    With ``documents`` set (as given to ``compile_documents(..)``),
+    only these documents are considered, and ``first`` is ignored.
+    See ``select_documents(..)``:
+
+        >>> list(traverse_all(stream, 'b.x', documents='-1,0',
+        ...                   default='none'))
+        [1, 'none']
 
     """
+    path = compile_path(path)
+    if documents is not None:
+        documents = compile_documents(documents)
+        if not isinstance(stream, (LoadedDocuments, DocumentSlices)):
+            for value in select_documents(stream, path, default=default,
+                                          loader=loader, streaming=streaming,
+                                          documents=documents):
+                yield value
+            return
+        ## an empty stream is one ``null`` document, yielded below
+        positions = documents.positions(len(stream) or 1)
+        if not positions:
+            return
+        stream = stream.__class__(stream[position] for position in positions
+                                  if stream)
+        first = False
     at_least_one_content = False
-    for content in yaml.load_all(stream, Loader=loader):
+    for value in iter_contents(stream, path, default, loader, first,
+                               streaming):
         at_least_one_content = True
-        value = traverse(content, key, default=default)
-        yield act(action, value, dump=dump)
+        yield value
+        if first:
+            return
 
     ## In case of empty stream, we consider that it is equivalent
     ## to one document having the ``null`` value.
     if at_least_one_content is False:
-        value = traverse(None, key, default=default)
-        yield act(action, value, dump=dump)
+        yield traverse(None, path, default=default)
 
 
-def main(args):  ## pylint: disable=too-many-branches
-    """Entrypoint of the whole commandline application"""
+def iter_contents(stream, path, default, loader, first, streaming):
+    """Yields target value of ``path`` in each document of ``stream``
 
-    EXNAME = os.path.basename(__file__ if WIN32 else sys.argv[0])
+    ``stream`` is not empty. Parsed documents are walked by
+    ``PathComposer`` when it can skip some of their parts.
 
-    for ext in (".py", ".pyc", ".exe", "-script.py", "-script.pyc"):  ## pragma: no cover
-        if EXNAME.endswith(ext):  ## pragma: no cover
-            EXNAME = EXNAME[:-len(ext)]
-            break
+    """
+    if isinstance(stream, LoadedDocuments):
+        return (traverse(content, path, default=default)
+                for content in stream)
+    if isinstance(stream, DocumentSlices):
+        return (value for text in stream
+                for value in traverse_all(text, path, default=default,
+                                          loader=loader,
+                                          streaming=streaming))
+    if first or streaming or prunes(path):
+        return _traverse_all(stream, path, default, loader, first,
+                             streaming)
+    return (traverse(content, path, default=default)
+            for content in yaml.load_all(stream,
+                                         Loader=loader or ShyamlSafeLoader))
+
+
+def prunes(path):
+    """Tells if walking documents at event level is worth it for ``path``
+
+    Values targeted by the walk are composed by python code, which is
+    slower than loading the whole document (in C with libyaml). So
+    the walk only pays off if it skips more than the siblings of a
+    top-level key: the targeted value would often be the bulk of the
+    document. The walk can't skip anything from a wildcard.
 
-    USAGE = """\
-    Usage:
+    """
+    return len(path.steps) > 1 and not isinstance(path.steps[0][0], Wildcard)
 
-        %(exname)s {-h|--help}
-        %(exname)s {-V|--version}
-        %(exname)s [-y|--yaml] [-q|--quiet] ACTION KEY [DEFAULT]
-    """ % {"exname": EXNAME}
 
-    HELP = """
-    Parses and output chosen subpart or values from YAML input.
-    It reads YAML in stdin and will output on stdout it's return value.
+def _traverse_all(stream, path, default, loader, first, streaming):
+    loader = (loader or ShyamlSafeLoader)(stream)
+    composer = PathComposer(loader, first=first, streaming=streaming)
+    try:
+        composer.get_event()  ## StreamStartEvent
+        while not composer.check_event(yaml.StreamEndEvent):
+            composer.get_event()  ## DocumentStartEvent
+            try:
+                try:
+                    value = composer.walk_node(path.steps)
+                except (IndexOutOfRange, MissingKeyError):
+                    if default is None:
+                        raise
+                    value = default
+            except PATH_ERRORS as exc:
+                raise invalid_path(path.path, exc)
+            if first:
+                yield value
+                return
+            if streaming:
+                ## The value may still need to read its events
+                yield value
+                composer.drain()
+                composer.get_event()  ## DocumentEndEvent
+                composer.reset()
+                continue
+            composer.get_event()  ## DocumentEndEvent
+            composer.reset()
+            yield value
+    finally:
+        loader.dispose()
 
-%(usage)s
 
-    Options:
+class ActionTypeError(Exception):
 
-        -y, --yaml
-                  Output only YAML safe value, more precisely, even
-                  literal values will be YAML quoted. This behavior
-                  is required if you want to output YAML subparts and
-                  further process it. If you know you have are dealing
-                  with safe literal value, then you don't need this.
-                  (Default: no safe YAML output)
+    def __init__(self, action, provided, expected):
+        self.action = action
+        self.provided = provided
+        self.expected = expected
 
-        -q, --quiet
-                  In case KEY value queried is an invalid path, quiet
-                  mode will prevent the writing of an error message on
-                  standard error.
-                  (Default: no quiet mode)
+    def __reduce__(self):
+        ## as ``args`` doesn't hold all the arguments of ``__init__``
+        return (self.__class__, (self.action, self.provided, self.expected))
 
-        -L, --line-buffer
-                  Force parsing stdin line by line allowing to process
-                  streamed YAML as it is fed instead of buffering
-                  input and treating several YAML streamed document
-                  at once. This is likely to have some small performance
-                  hit if you have a huge stream of YAML document, but
-                  then you probably don't really care about the
-                  line-buffering.
-                  (Default: no line buffering)
+    def __str__(self):
+        return ("%s does not support %r type. "
+                "Please provide or select a %s."
+                % (self.action, self.provided,
+                   self.expected[0] if len(self.expected) == 1 else
+                   ("%s or %s" % (", ".join(self.expected[:-1]),
+                                  self.expected[-1]))))
 
-        ACTION    Depending on the type of data you've targetted
-                  thanks to the KEY, ACTION can be:
 
-                  These ACTIONs applies to any YAML type:
+def act(action, value, dump=yaml_dump):
+    r"""Returns an iterator on the output chunks of ``action`` on ``value``
+
+    Sequences and structs are dumped one element at a time, so the
+    output can be written as it is produced. Errors are raised by the
+    call itself, before any chunk is to be written:
+
+        >>> list(act("get-values", [1, "a"], dump=magic_dump))
+        ['1\n', 'a\n']
+        >>> list(act("keys-0", {"a": 1}, dump=magic_dump))
+        ['a\x00']
+        >>> list(act("get-length", [1, "a"]))
+        [2]
+        >>> act("get-length", 1)  ## doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        ActionTypeError: get-length does not support 'int' type. ...
 
-                    get-type          ## returns a short string
-                    get-value         ## returns YAML
+    """
+    chunks = act_chunks(action, value, dump)
+    for chunk in chunks:  ## raises the errors of ``action`` now
+        return itertools.chain((chunk, ), chunks)
+    return iter(())
 
-                  These ACTIONs applies to 'sequence' and 'struct' YAML type:
 
-                    get-values{,-0}   ## returns list of YAML
-                    get-length        ## returns an integer
+def act_chunks(action, value, dump):
+    """Returns the output of ``action`` on ``value``, see ``act(..)``"""
+    if action not in ACTION_CHUNKS:
+        raise InvalidAction(action)
+    ## Note: ``\n`` will be transformed by ``universal_newlines`` mecanism for
+    ## any platform
+    termination = "\0" if action.endswith("-0") else "\n"
+    return ACTION_CHUNKS[action](action, value, dump, termination)
 
-                  These ACTION applies to 'struct' YAML type:
 
-                    keys{,-0}         ## returns list of YAML
-                    values{,-0}       ## returns list of YAML
-                    key-values,{,-0}  ## returns list of YAML
+def get_value_chunks(action, value, dump, termination):
+    if isinstance(value, Streamed):
+        for chunk in value.dump_chunks(dump):
+            yield chunk
+    else:
+        yield "%s" % dump(value)
 
-                  Note that any value returned is returned on stdout, and
-                  when returning ``list of YAML``, it'll be separated by
-                  a newline or ``NUL`` char depending of you've used the
-                  ``-0`` suffixed ACTION.
 
-        KEY       Identifier to browse and target subvalues into YAML
-                  structure. Use ``.`` to parse a subvalue. If you need
-                  to use a literal ``.`` or ``\\``, use ``\\`` to quote it.
+def get_values_chunks(action, value, dump, termination):
+    if isinstance(value, STRUCT_TYPES):
+        for k, v in value.items():
+            yield "".join((dump(k), termination, dump(v), termination))
+    elif isinstance(value, SEQUENCE_TYPES):
+        for l in value:
+            yield "".join((dump(l), termination))
+    else:
+        raise ActionTypeError(
+            action, provided=type_name(value),
+            expected=["sequence", "struct"])
 
-                  Use struct keyword to browse ``struct`` YAML data and use
-                  integers to browse ``sequence`` YAML data.
 
-        DEFAULT   if not provided and given KEY do not match any value in
-                  the provided YAML, then DEFAULT will be returned. If no
-                  default is provided and the KEY do not match any value
-                  in the provided YAML, %(exname)s will fail with an error
-                  message.
+def get_type_chunks(action, value, dump, termination):
+    yield type_name(value)
 
-    Examples:
 
-         ## get last grocery
-         cat recipe.yaml       | %(exname)s get-value groceries.-1
+def get_length_chunks(action, value, dump, termination):
+    if isinstance(value, Streamed):
+        yield value.count()
+    elif isinstance(value, (dict, list)):
+        yield len(value)
+    else:
+        raise ActionTypeError(
+            action, provided=type_name(value),
+            expected=["sequence", "struct"])
 
-         ## get all words of my french dictionary
-         cat dictionaries.yaml | %(exname)s keys-0 french.dictionary
 
-         ## get YAML config part of 'myhost'
-         cat hosts_config.yaml | %(exname)s get-value cfgs.myhost
+def struct_chunks(action, value, elements, output, termination):
+    """Yields ``output`` of each of ``elements`` of struct ``value``"""
+    if not isinstance(value, STRUCT_TYPES):
+        raise ActionTypeError(
+            action=action, provided=type_name(value), expected=["struct"])
+    for e in elements(value):
+        yield "".join((str(output(e)), termination))
 
-    """ % {"exname": EXNAME, "usage": USAGE}
 
-    USAGE = textwrap.dedent(USAGE)
-    HELP = textwrap.dedent(HELP)
+def keys_chunks(action, value, dump, termination):
+    return struct_chunks(action, value, lambda v: v.keys(), dump,
+                         termination)
 
-    opts = _parse_args(args, USAGE, HELP)
-    quiet = opts.pop("quiet")
 
-    try:
-        first = True
-        for output in do(stream=sys.stdin, **opts):
-            if first:
-                first = False
-            else:
-                if opts["action"] not in ACTION_SUPPORTING_STREAMING:
-                    die("Source YAML is multi-document, "
-                        "which doesn't support any other action than %s"
-                        % ", ".join(ACTION_SUPPORTING_STREAMING))
-                if opts["dump"] is yaml_dump:
-                    print("---\n", end="")
-                else:
-                    print("\0", end="")
-                if opts.get("loader") is LineLoader:
-                    sys.stdout.flush()
-
-            safe_print(output)
-            if opts.get("loader") is LineLoader:
-                sys.stdout.flush()
-    except (InvalidPath, ActionTypeError) as e:
+def values_chunks(action, value, dump, termination):
+    return struct_chunks(action, value, lambda v: v.values(), dump,
+                         termination)
+
+
+def key_values_chunks(action, value, dump, termination):
+    return struct_chunks(
+        action, value, lambda v: v.items(),
+        lambda x: termination.join("%s" % dump(e) for e in x), termination)
+
+
+ACTION_CHUNKS = {
+    "get-value": get_value_chunks,
+    "get-values": get_values_chunks,
+    "get-values-0": get_values_chunks,
+    "get-type": get_type_chunks,
+    "get-length": get_length_chunks,
+    "keys": keys_chunks,
+    "keys-0": keys_chunks,
+    "values": values_chunks,
+    "values-0": values_chunks,
+    "key-values": key_values_chunks,
+    "key-values-0": key_values_chunks,
+}
+
+##
+## Input files
+##
+
+MAP_RELEASE_SIZE = 4 * 1024 * 1024
+
+
+class MappedFile(object):
+    """Read-only memory map of a file, usable as a binary file object
+
+    PyYAML loaders read it by chunks through ``.read(size)``, which are
+    copied straight from the page cache, instead of going through the
+    buffers (and the decoding in the case of stdin) of file objects.
+
+    Pages already read are released by blocks of ``MAP_RELEASE_SIZE``
+    bytes (when ``madvise`` is available), so that the whole file
+    doesn't end up counted in the memory of the process.
+
+    """
+
+    def __init__(self, f):
+        self.name = f.name
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.map.seek(os.lseek(f.fileno(), 0, os.SEEK_CUR))
+        self.readline = self.map.readline
+        self.close = self.map.close
+        self.released = 0
+        self.dontneed = getattr(mmap, "MADV_DONTNEED", None) \
+            if hasattr(self.map, "madvise") else None  ## python >= 3.8
+
+    def read(self, size=-1):
+        data = self.map.read(size)
+        if self.dontneed is not None:
+            end = self.map.tell() - self.map.tell() % MAP_RELEASE_SIZE
+            if end > self.released:
+                self.map.madvise(self.dontneed, self.released,
+                                 end - self.released)
+                self.released = end
+        return data
+
+    def __iter__(self):
+        return iter(self.map.readline, b"")
+
+
+def open_input(filename):
+    """Returns a YAML stream on file ``filename``
+
+    Non-empty regular files are memory mapped with ``MappedFile``,
+    other files are opened in binary mode.
+
+    Stdin is never mapped, even when redirected from a file, so that
+    it is still decoded as text with the locale encoding.
+
+    """
+    f = open(filename, "rb")
+    try:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or not st.st_size:
+            return f
+        mapped = MappedFile(f)
+    except (EnvironmentError, ValueError):  ## not mappable
+        return f
+    f.close()  ## the map doesn't need the file to stay open
+    return mapped
+
+
+##
+## JSON input
+##
+
+JSON_BLANKS = " \t\r\n"
+
+
+def reject_constant(name):
+    raise ValueError("%s is not valid JSON" % name)
+
+
+def parse_float(text):
+    """Returns JSON number ``text`` as YAML would read it
+
+    YAML 1.1 floats need a dot, and a sign in their exponent, so
+    that ``1e3`` is a string.
+
+    """
+    ## ``scalar_dumper`` has the implicit resolvers of the loader
+    if scalar_dumper.resolve(yaml.ScalarNode, text, (True, False)) \
+           == FLOAT_TAG:
+        return float(text)
+    return text
+
+
+def load_json(content, first=False):
+    r"""Returns ``LoadedDocuments`` of JSON ``content``, ``None`` if invalid
+
+    This is much faster than loading it as YAML, of which JSON is a
+    subset. ``content`` can hold several JSON values, one per line
+    as in JSON Lines, each one being a document:
+
+        >>> documents = load_json('{"b": 1, "a": [true, null]}\n"c"\n')
+        >>> [list(documents[0].items()), documents[1]]
+        [[('b', 1), ('a', [True, None])], 'c']
+
+    ``None`` is returned for any content that isn't (only) JSON, which
+    then has to be loaded as YAML:
+
+        >>> load_json("a: 1"), load_json("1 2"), load_json("")
+        (None, None, None)
+
+    With ``first`` set, only the first value is parsed.
+
+    """
+    if isinstance(content, bytes):
+        try:
+            content = content.decode("utf-8")
+        except UnicodeDecodeError:
+            return None  ## JSON is UTF-8 encoded
+    try:
+        return LoadedDocuments(json_values(content, first=first)) or None
+    except ValueError:
+        return None
+
+
+def json_values(text, first=False):
+    r"""Yields the JSON values of ``text``, each one on its own line
+
+    :raises ValueError: if ``text`` is not JSON values only, or if
+        several values are on the same line:
+
+        >>> list(json_values('1\n[2]'))
+        [1, [2]]
+        >>> list(json_values('1 2'))
+        Traceback (most recent call last):
+        ...
+        ValueError: JSON values must be on their own lines.
+
+    """
+    import json
+
+    decode = json.JSONDecoder(object_pairs_hook=MyOrderedDict,
+                              parse_float=parse_float,
+                              parse_constant=reject_constant).raw_decode
+    idx, end = 0, len(text)
+    while True:
+        start = idx
+        while idx < end and text[idx] in JSON_BLANKS:
+            idx += 1
+        if idx == end:
+            return
+        if start and "\n" not in text[start:idx]:
+            ## "1 2" is a YAML string
+            raise ValueError("JSON values must be on their own lines.")
+        value, idx = decode(text, idx)
+        yield value
+        if first:
+            return
+
+
+def read_json_input(stream, first=False):
+    """Returns ``LoadedDocuments`` of JSON ``stream``, or its content
+
+    The content is returned if it isn't JSON, to be loaded as YAML.
+
+    """
+    content = stream.read()
+    return load_json(content, first=first) or content
+
+
+##
+## On-disk cache
+##
+
+CACHE_VERSION = 1
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+
+class LoadedDocuments(list):
+    """Already loaded YAML documents, usable in place of a stream"""
+
+
+def cache_dir():
+    """Returns the directory where to store the parsed YAML files"""
+    return os.environ.get("SHYAML_CACHE_DIR") or \
+        os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                     os.path.join(os.path.expanduser("~"), ".cache"),
+                     "shyaml")
+
+
+def load_all_cached(filename, loader=None, directory=None, max_size=None):
+    """Returns ``LoadedDocuments`` of YAML file, using an on-disk cache
+
+    Cache entries are keyed by the path, size, modification time and
+    content of the file, and hold the pickled documents. When the
+    total size of the cache directory grows over ``max_size``, least
+    recently used entries are removed.
+
+    As unpickling runs code, the cache is ignored altogether if its
+    directory or entries are not owned by the current user, or are
+    writable by others.
+
+    """
+    import hashlib
+
+    directory = directory or cache_dir()
+    if max_size is None:
+        max_size = int(os.environ.get("SHYAML_CACHE_SIZE", CACHE_MAX_SIZE))
+    stream = open_input(filename)
+    try:
+        content = stream.map if isinstance(stream, MappedFile) \
+            else stream.read()
+        st = os.stat(filename)
+        key = hashlib.sha1(
+            ("%s\0%d\0%r\0%s\0%d\0%s\0"
+             % (os.path.realpath(filename), st.st_size, st.st_mtime,
+                "%s.%s" % (loader.__module__, loader.__name__)
+                if loader else "default", CACHE_VERSION,
+                sys.version_info[0])).encode("utf-8"))
+        key.update(content)
+        entry = os.path.join(directory, "%s.pickle" % key.hexdigest())
+        documents = read_cache_entry(entry)
+        if documents is not None:
+            return documents
+        documents = LoadedDocuments(yaml.load_all(
+            stream if isinstance(stream, MappedFile) else content,
+            Loader=loader or ShyamlSafeLoader))
+    finally:
+        stream.close()
+    write_cache_entry(entry, documents, max_size)
+    return documents
+
+
+def is_private(path):
+    """Tells if ``path`` is owned by us and not writable by others"""
+    st = os.stat(path)
+    getuid = getattr(os, "getuid", None)  ## not available on windows
+    return (getuid is None or st.st_uid == getuid()) and \
+        not st.st_mode & 0o022
+
+
+def read_cache_entry(entry):
+    """Returns the documents of cache file ``entry``, or ``None``"""
+    import pickle
+
+    try:
+        if not (is_private(os.path.dirname(entry)) and is_private(entry)):
+            return None
+        with open(entry, "rb") as f:
+            documents = pickle.load(f)
+    except Exception:  ## missing or unreadable entry
+        return None
+    os.utime(entry, None)  ## mark as recently used
+    return documents
+
+
+def write_cache_entry(entry, documents, max_size):
+    """Stores ``documents`` in cache file ``entry``, if the cache is safe"""
+    import pickle
+
+    directory = os.path.dirname(entry)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        if not is_private(directory):
+            return
+        tmp = "%s.%d.tmp" % (entry, os.getpid())
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                               0o600), "wb") as f:
+            pickle.dump(documents, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, entry)
+        evict_cache(directory, max_size)
+    except EnvironmentError:  ## cache is only a best effort
+        pass
+
+
+def evict_cache(directory, max_size):
+    """Removes least recently used cache entries over ``max_size``"""
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(".pickle"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:  ## removed concurrently
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    total = sum(size for _mtime, size, _path in entries)
+    for _mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:  ## removed concurrently
+            continue
+        total -= size
+
+
+##
+## Document selection
+##
+
+class DocumentSelection(object):
+    r"""Parsed ``--doc`` SPEC, the positions of the documents to consider
+
+    SPEC is a comma separated list of positions (starting from 0) and
+    of python-like slices, for ranges and every-Nth documents:
+
+        >>> selection = DocumentSelection('1,4:6,10::5')
+        >>> [position for position in range(30) if position in selection]
+        [1, 4, 5, 10, 15, 20, 25]
+
+    ``stop`` is the position after the last document that can be
+    selected, ``None`` if there is no such position, and ``0`` if no
+    document can be selected:
+
+        >>> DocumentSelection('1,4:6').stop, selection.stop
+        (6, None)
+        >>> DocumentSelection('2:10:4').stop, DocumentSelection('0:0').stop
+        (7, 0)
+
+    Negative positions count from the end, so they need the number of
+    documents (``counted`` is set) and can only be resolved by
+    ``positions(..)``:
+
+        >>> selection = DocumentSelection('-1,0')
+        >>> selection.counted, selection.positions(3)
+        (True, [0, 2])
+
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.items = tuple(self.parse_item(item) for item in spec.split(","))
+        self.indexes = frozenset(item for item in self.items
+                                 if not isinstance(item, slice))
+        self.slices = tuple((item.start or 0, item.stop, item.step or 1)
+                            for item in self.items
+                            if isinstance(item, slice))
+        self.counted = any(index < 0 for index in self.indexes) or \
+            any(start < 0 or step < 0 or stop is not None and stop < 0
+                for start, stop, step in self.slices)
+        stops = [index + 1 for index in self.indexes] + \
+            [self.slice_stop(*item) for item in self.slices]
+        self.stop = None if self.counted or None in stops else \
+            max(stops + [0])
+
+    @staticmethod
+    def slice_stop(start, stop, step):
+        """Returns the position after the last one of a non-negative slice
+
+        It is ``None`` if the slice has no end, and ``0`` if it is empty.
+
+        """
+        if stop is None:
+            return None
+        if start >= stop:
+            return 0
+        return stop - (stop - 1 - start) % step
+
+    @staticmethod
+    def parse_item(item):
+        if ":" not in item:
+            return int(item)
+        parts = item.split(":")
+        if len(parts) > 3:
+            raise ValueError("invalid slice %r" % item)
+        bounds = [int(part) if part.strip() else None for part in parts]
+        if bounds[2:3] == [0]:
+            raise ValueError("slice step cannot be zero")
+        return slice(*bounds)
+
+    def __repr__(self):
+        return "<DocumentSelection %r>" % (self.spec, )
+
+    def __contains__(self, position):
+        """Tells if non-negative ``position`` is selected (not ``counted``)"""
+        if position in self.indexes:
+            return True
+        for start, stop, step in self.slices:
+            if start <= position and (stop is None or position < stop) and \
+                   not (position - start) % step:
+                return True
+        return False
+
+    def positions(self, count):
+        """Returns sorted selected positions among ``count`` documents
+
+        :raises MissingDocument: if a position (not a slice) is out of
+            range.
+
+        """
+        positions = set()
+        for item in self.items:
+            if isinstance(item, slice):
+                positions.update(range(*item.indices(count)))
+            elif -count <= item < count:
+                positions.add(item % count)
+            else:
+                raise MissingDocument(item, count)
+        return sorted(positions)
+
+    def select(self, texts):
+        """Yields the selected ones of ``texts``, in order
+
+        Reading of ``texts`` stops after the last one that can be
+        selected, unless the selection is ``counted``, which needs them
+        all. No text is considered as one empty text, as an empty
+        stream is one ``null`` document:
+
+            >>> list(DocumentSelection('1:').select(iter('abc')))
+            ['b', 'c']
+            >>> list(DocumentSelection('-1').select(iter([])))
+            ['']
+
+        :raises MissingDocument: when selected positions are missing.
+
+        """
+        if self.counted:
+            texts = list(texts) or [u""]
+            for position in self.positions(len(texts)):
+                yield texts[position]
+            return
+        if self.stop == 0:  ## empty selection, nothing to read
+            return
+        count = 0
+        for text in texts:
+            if count in self:
+                yield text
+            count += 1
+            if count == self.stop:
+                return
+        if not count and 0 in self:
+            yield u""
+        self.positions(max(count, 1))  ## raises on missing positions
+
+
+def compile_documents(documents):
+    """Returns the ``DocumentSelection`` of ``documents``
+
+    ``documents`` is a ``--doc`` SPEC string, positions, or already a
+    ``DocumentSelection``:
+
+        >>> compile_documents([2, 0]).positions(3)
+        [0, 2]
+
+    :raises ValueError: on invalid SPEC.
+
+    """
+    if isinstance(documents, DocumentSelection):
+        return documents
+    if not isinstance(documents, (bytes, type(u""))):
+        documents = ",".join(str(position) for position in documents)
+    return DocumentSelection(documents)
+
+
+def select_documents(stream, path, default=None, loader=None,
+                     streaming=False, documents=None):
+    r"""Yields target value of ``path`` in selected documents of ``stream``
+
+    As ``traverse_all(..)``, but for the documents of ``documents`` (a
+    ``DocumentSelection``) only. Documents are split as by
+    ``split_documents(..)``, so unselected ones are only scanned for
+    their boundaries and never parsed, and reading of ``stream``
+    stops after the last document that can be selected:
+
+        >>> list(select_documents(iter(['a: 1\n', '---\n', 'a: [\n',
+        ...                             '---\n', 'a: 3\n', '---\n', 'a: [']),
+        ...                       'a', documents=DocumentSelection('0,2')))
+        [1, 3]
+
+    ``counted`` selections need all the texts of the documents to be
+    read before parsing any, see ``DocumentSelection.select(..)``.
+
+    :raises MissingDocument: when selected positions are missing.
+
+    """
+    if isinstance(stream, (bytes, type(u""))):
+        stream = stream.splitlines(True)
+    if loader is LineLoader:
+        loader = None  ## texts are whole documents, reads can't block
+    for text in documents.select(split_documents(stream)):
+        for value in traverse_all(text, path, default=default,
+                                  loader=loader, streaming=streaming):
+            yield value
+
+
+##
+## Document index
+##
+
+INDEX_MAGIC = b"SHYAMLIX"
+INDEX_VERSION = 1
+INDEX_HEADER = "<8sQQQQ"  ## magic, version, size, mtime (ns), count
+INDEX_ENTRY = "<QQ"  ## start and end offsets of a document
+
+
+class DocumentSlices(list):
+    """Texts of single YAML documents, usable in place of a stream"""
+
+
+def index_path(filename):
+    """Returns the path of the sidecar index file of ``filename``"""
+    return filename + ".shyaml-index"
+
+
+def file_version(filename):
+    """Returns what identifies the current content of ``filename``"""
+    st = os.stat(filename)
+    mtime = getattr(st, "st_mtime_ns", None)
+    return st.st_size, int(st.st_mtime * 10 ** 9) if mtime is None \
+        else mtime
+
+
+def document_offsets(content):
+    r"""Yields ``(start, end)`` offsets of each YAML document of ``content``
+
+    Documents are the ones of ``split_documents(..)``, but boundaries
+    are searched for by regular expressions, which is a lot faster
+    than reading ``content`` line by line:
+
+        >>> list(document_offsets(b'# intro\na: 1\n--- b\n...\n# end\n'))
+        [(0, 13), (13, 23)]
+
+    """
+    markers = re.compile(br"^(---|\.\.\.)(?=[ \t\r\n]|\Z)", re.M)
+    has_content = re.compile(br"^[ \t\r\x0b\x0c]*[^ \t\r\n\x0b\x0c#%]",
+                             re.M).search
+    start = scanned = 0
+    document = False  ## whether text since ``start`` holds a document
+    for match in markers.finditer(content):
+        if not document:
+            document = has_content(content, scanned, match.start()) \
+                is not None
+        line_end = content.find(b"\n", match.start()) + 1 or len(content)
+        if match.group(1) == b"---":
+            if document:
+                yield start, match.start()
+                start = match.start()
+            document = True
+        else:
+            if document:
+                yield start, line_end
+            start, document = line_end, False
+        scanned = line_end
+    if document or has_content(content, scanned, len(content)):
+        yield start, len(content)
+
+
+def build_index(filename):
+    """Writes the sidecar index of the documents of ``filename``
+
+    Returns the number of documents. The index is written to a
+    temporary file renamed at the end, so it is never seen partial.
+
+    :raises InvalidInput: if ``filename`` is encoded in UTF-16 or
+        UTF-32, as document markers are searched as UTF-8 bytes.
+
+    """
+    version = file_version(filename)
+    stream = open_input(filename)
+    try:
+        content = stream.map if isinstance(stream, MappedFile) else \
+            stream.read()
+        ## offsets are found by searching ASCII markers in the bytes
+        if content[:2] in (b"\xfe\xff", b"\xff\xfe") or \
+               b"\x00" in content[:2]:
+            raise InvalidInput("UTF-16 and UTF-32 files can't be indexed.")
+        offsets = list(document_offsets(content))
+    finally:
+        stream.close()
+    path = index_path(filename)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(struct.pack(INDEX_HEADER, INDEX_MAGIC, INDEX_VERSION,
+                            version[0], version[1], len(offsets)))
+        for start, end in offsets:
+            f.write(struct.pack(INDEX_ENTRY, start, end))
+    os.rename(tmp, path)
+    return len(offsets)
+
+
+def read_index(filename, documents):
+    """Returns ``DocumentSlices`` of ``documents`` of ``filename``
+
+    ``documents`` is as given to ``compile_documents(..)``. Only
+    their texts are read from the file, thanks to its sidecar index.
+    ``None`` is returned if there is no index, or if it is outdated
+    (the file changed since it was indexed).
+
+    :raises MissingDocument: on positions of missing documents.
+
+    """
+    header_size = struct.calcsize(INDEX_HEADER)
+    entry_size = struct.calcsize(INDEX_ENTRY)
+    try:
+        index = open(index_path(filename), "rb")
+    except EnvironmentError:
+        return None
+    with index:
+        header = index.read(header_size)
+        if len(header) != header_size:
+            return None
+        magic, version, size, mtime, count = struct.unpack(INDEX_HEADER,
+                                                           header)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or \
+               (size, mtime) != file_version(filename):
+            return None
+        ## an empty stream is one ``null`` document
+        positions = compile_documents(documents).positions(count or 1)
+        if not count:
+            return DocumentSlices(b"" for _ in positions)
+        slices = DocumentSlices()
+        with open(filename, "rb") as f:
+            for position in positions:
+                index.seek(header_size + entry_size * position)
+                start, end = struct.unpack(INDEX_ENTRY,
+                                           index.read(entry_size))
+                f.seek(start)
+                slices.append(f.read(end - start))
+    return slices
+
+
+def select_input(stream, filename, documents, indexed=True):
+    """Returns ``(stream, documents)`` with only the selected documents
+
+    ``documents`` is the ``DocumentSelection`` given to ``--doc``.
+    When the texts of the documents could be read thanks to the
+    index of ``filename`` (if ``indexed``), the returned ``stream``
+    holds only them and the returned ``documents`` is ``None``.
+    Otherwise both are returned unchanged, to be given to ``do(..)``.
+
+    :raises MissingDocument: on positions of missing documents.
+
+    """
+    if isinstance(stream, LoadedDocuments):
+        return stream, documents
+    if indexed and filename is not None:
+        try:
+            slices = read_index(filename, documents)
+        except EnvironmentError:
+            slices = None
+        if slices is not None:
+            stream.close()
+            return slices, None
+    return stream, documents
+
+
+def main_index(filenames):
+    """Builds the index of each of ``filenames``, returns exit status"""
+    status = 0
+    for filename in filenames:
+        try:
+            build_index(filename)
+        except EnvironmentError as e:
+            stderr("Error: %s: %s\n" % (filename, e.strerror))
+            status = 1
+        except InvalidInput as e:
+            stderr("Error: %s: %s\n" % (filename, e))
+            status = 1
+    return status
+
+
+def do(stream, action, key, default=None, dump=yaml_dump,
+       loader=None, first=False, chunked=False, streaming=False,
+       stats=None, documents=None):
+    """Return string representations of target value in stream YAML
+
+    The key is used for traversal of the YAML structure to target
+    the value that will be dumped.
+
+    :param stream:  file like input yaml content, or ``LoadedDocuments``
+    :param action:  string identifying one of the possible supported actions
+    :param key:     string dotted expression to traverse yaml input, or
+                    its ``KeyPath`` as returned by ``compile_path(..)``
+    :param default: optional default value in case of missing end value when
+                    traversing input yaml.  (default is ``None``)
+    :param dump:    callable that will be given python objet to dump in yaml
+                    (default is ``yaml_dump``)
+    :param loader:  PyYAML's *Loader subclass to parse YAML
+                    (default is ShyamlSafeLoader)
+    :param first:   only consider the first YAML document, and stop
+                    reading the stream as soon as its result is known.
+                    (default is ``False``)
+    :param chunked: yield the output of each YAML doc as the generator
+                    of chunks given by ``act(..)``, to write big outputs
+                    without holding them in memory.
+                    (default is ``False``)
+    :param streaming: read targeted sequences and structs one element
+                    at a time, to use a constant amount of memory.
+                    The first occurrence of duplicate keys wins.
+                    (default is ``False``)
+    :param stats:   ``Stats`` instance to account the documents, and
+                    the time spent loading them and acting on them.
+                    (default is ``None``)
+    :param documents: only consider these documents, as given to
+                    ``compile_documents(..)``. Others are not parsed,
+                    and reading of the stream stops after the last
+                    one. ``first`` is then ignored.
+                    (default is ``None``, for all documents)
+    :return:        generator of string representation of target value per
+                    YAML docs in the given stream.
+
+    :raises ActionTypeError: when there's a type mismatch between the
+        action selected and the type of the targetted value.
+        (ie: action 'key-values' on non-struct)
+    :raises InvalidAction: when selected action is not a recognised valid
+        action identifier.
+    :raises InvalidPath: upon inexistent content when traversing YAML
+        input following the key specification.
+    :raises MissingDocument: when selected ``documents`` are missing.
+
+    """
+    values = traverse_all(stream, key, default=default, loader=loader,
+                          first=first, streaming=streaming,
+                          documents=documents)
+    if stats is not None:
+        values = stats.timed("load", values)
+    for value in values:
+        chunks = act(action, value, dump=dump)
+        if stats is not None:
+            stats.documents += 1
+            chunks = stats.timed("act", chunks)
+        yield chunks if chunked else join_chunks(chunks)
+
+
+QUERY_ERRORS = (InvalidPath, ActionTypeError, InvalidOutput)
+
+
+def do_many(stream, queries, dump=yaml_dump, loader=None, first=False,
+            chunked=False, stats=None, documents=None, keep_going=False):
+    r"""Return string representations of several queries on stream YAML
+
+    Contrary to calling ``do(..)`` for each query, the stream is
+    parsed only once.
+
+        >>> list(do_many('a: 1\nb: [x, y]\n',
+        ...              [("get-value", "a", None),
+        ...               ("get-length", "b", None),
+        ...               ("get-value", "c", "none")],
+        ...              dump=magic_dump))
+        ['1', 2, 'none']
+
+    With ``keep_going`` set, the errors of a query (as ``InvalidPath``)
+    are yielded in place of its output, and the next queries are still
+    answered:
+
+        >>> list(do_many('a: 1\n', [("get-value", "b", None),
+        ...                         ("get-value", "a", None)],
+        ...              dump=magic_dump, keep_going=True))
+        [InvalidPath("invalid path 'b', missing key 'b' in struct."), '1']
+
+    :param stream:  file like input yaml content
+    :param queries: iterable of ``(action, key, default)`` tuples, with
+                    the same meaning than the arguments of ``do(..)``
+    :param dump:    callable that will be given python objet to dump in yaml
+                    (default is ``yaml_dump``)
+    :param loader:  PyYAML's *Loader subclass to parse YAML
+                    (default is ShyamlSafeLoader)
+    :param first:   only consider the first YAML document.
+                    (default is ``False``)
+    :param chunked: as in ``do(..)``.
+                    (default is ``False``)
+    :param stats:   as in ``do(..)``.
+                    (default is ``None``)
+    :param documents: as in ``do(..)``.
+                    (default is ``None``)
+    :param keep_going: yield the ``QUERY_ERRORS`` of a query instead of
+                    raising them.
+                    (default is ``False``)
+    :return:        generator of string representation of target value of
+                    each query, per YAML docs in the given stream.
+
+    :raises ActionTypeError, InvalidAction, InvalidPath, MissingDocument:
+        as ``do(..)``.
+
+    """
+    queries = [(action, compile_path(key), default)
+               for action, key, default in queries]
+    contents = traverse_all(stream, None, loader=loader, first=first,
+                            documents=documents)
+    if stats is not None:
+        contents = stats.timed("load", contents)
+    for content in contents:
+        if stats is not None:
+            stats.documents += 1
+        for query in queries:
+            try:
+                chunks = answer(content, query, dump, stats)
+                if not chunked:
+                    chunks = join_chunks(chunks)
+            except QUERY_ERRORS as e:
+                if not keep_going:
+                    raise
+                chunks = e
+            yield chunks
+
+
+def answer(content, query, dump, stats=None):
+    """Returns ``act(..)`` output chunks of ``query`` on ``content``"""
+    action, key, default = query
+    if stats is None:
+        value = traverse(content, key, default=default)
+        return act(action, value, dump=dump)
+    value = stats.call("traverse", traverse, content, key, default=default)
+    return stats.timed("act", act(action, value, dump=dump))
+
+
+def join_chunks(chunks):
+    """Returns ``act(..)`` output chunks as one value
+
+        >>> join_chunks(act("get-length", [1, 2]))
+        2
+        >>> join_chunks(act("keys", {"a": 1, "b": 2}, dump=magic_dump))
+        'a\\nb\\n'
+
+    """
+    chunks = list(chunks)
+    return chunks[0] if len(chunks) == 1 else "".join(chunks)
+
+
+##
+## Parsed documents
+##
+
+DOCUMENT_CACHE_SIZE = 1024
+
+
+class Document(object):
+    r"""Parsed YAML document, to answer many queries without parsing again
+
+        >>> doc = Document.load('a: 1.1\nb: {x: foo, y: [1, 2]}\n')
+        >>> doc.get("b.y.-1"), doc.type("a"), doc.length("b.y")
+        (2, 'float', 2)
+        >>> doc.keys("b"), doc.values("b.y")
+        (('x', 'y'), (1, 2))
+        >>> doc.get("c", default="none")
+        'none'
+        >>> print(doc.query("get-value", "b", dump=magic_dump))
+        x: foo
+        y:
+        - 1
+        - 2
+        <BLANKLINE>
+
+    Errors are the ones of ``do(..)``:
+
+        >>> doc.keys("a")  ## doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        ActionTypeError: keys does not support 'float' type. Please
+        provide or select a struct.
+
+    Results are memoized in a bounded cache, per query, so repeated
+    lookups only cost a dict access. Queries can be made from several
+    threads at once. As values are shared between queries, they must
+    not be modified.
+
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self._cache = {}
+
+    @classmethod
+    def load(cls, stream, loader=None):
+        """Returns the ``Document`` of the single YAML document of ``stream``
+
+        ``stream`` is YAML content (bytes or text) or a file object.
+
+        """
+        return cls(yaml.load(stream, Loader=loader or ShyamlSafeLoader))
+
+    @classmethod
+    def load_all(cls, stream, loader=None):
+        r"""Returns the list of ``Document`` of each document of ``stream``
+
+            >>> [doc.get() for doc in Document.load_all('1\n--- 2\n')]
+            [1, 2]
+
+        As with ``do(..)``, an empty stream holds one ``null`` document.
+
+        """
+        values = yaml.load_all(stream,
+                               Loader=loader or ShyamlSafeLoader)
+        return [cls(value) for value in values] or [cls(None)]
+
+    def _memoized(self, cache_key, fn, *args):
+        try:
+            return self._cache[cache_key]
+        except KeyError:
+            pass
+        except TypeError:  ## unhashable default
+            return fn(*args)
+        result = fn(*args)
+        if len(self._cache) >= DOCUMENT_CACHE_SIZE:
+            ## Drop the oldest entry (an arbitrary one before python 3.7)
+            try:
+                del self._cache[next(iter(self._cache))]
+            except (KeyError, RuntimeError, StopIteration):  ## concurrent use
+                pass
+        self._cache[cache_key] = result
+        return result
+
+    def get(self, key=None, default=None):
+        """Returns the python value targeted by ``key``"""
+        return self._memoized(("get", key, default), traverse,
+                              self.value, key, default)
+
+    def query(self, action, key=None, default=None, dump=yaml_dump):
+        """Returns the output of ``action``, as given by ``do(..)``"""
+        return self._memoized((action, key, default, dump), self._act,
+                              action, key, default, dump)
+
+    def _act(self, action, key, default, dump):
+        return join_chunks(act(action, self.get(key, default), dump=dump))
+
+    def type(self, key=None, default=None):
+        """Returns the type name of the value targeted by ``key``"""
+        return self.query("get-type", key, default)
+
+    def length(self, key=None, default=None):
+        """Returns the length of the struct or sequence targeted by ``key``"""
+        return self.query("get-length", key, default)
+
+    def keys(self, key=None, default=None):
+        """Returns the keys of the struct targeted by ``key``, as a tuple"""
+        return self._memoized(("keys", key, default), self._items,
+                              "keys", key, default, 0)
+
+    def values(self, key=None, default=None):
+        """Returns the values of the struct or sequence targeted by ``key``
+
+        They are returned as a tuple.
+
+        """
+        return self._memoized(("values", key, default), self._items,
+                              "values", key, default, 1)
+
+    def _items(self, action, key, default, idx):
+        value = self.get(key, default)
+        if isinstance(value, dict):
+            return tuple(item[idx] for item in value.items())
+        if action == "values" and isinstance(value, list):
+            return tuple(value)
+        raise ActionTypeError(
+            action, provided=type_name(value),
+            expected=["struct"] if action == "keys" else
+            ["sequence", "struct"])
+
+
+##
+## Parallel processing
+##
+
+PARALLEL_BATCH_SIZE = 64 * 1024
+PARALLEL_WINDOW = 2  ## batches submitted ahead, per process
+
+DOCUMENT_START = ("---", b"---")
+DOCUMENT_END = ("...", b"...")
+MARKER_ENDS = ("", " ", "\t", "\r", "\n", b"", b" ", b"\t", b"\r", b"\n")
+
+
+def split_documents(lines):
+    r"""Yields the text of each YAML document held in ``lines``
+
+    Documents are split on lines starting with a ``---`` or ``...``
+    marker, as these can't start a line of YAML content. Directives
+    are kept with the document they precede, and text without any
+    document is dropped:
+
+        >>> list(split_documents(['# intro\n', 'a: 1\n', '--- b\n',
+        ...                       '...\n', '%YAML 1.1\n', '---\n',
+        ...                       '...\n', '# end\n']))
+        ['# intro\na: 1\n', '--- b\n...\n', '%YAML 1.1\n---\n...\n']
+
+    """
+    splitter = DocumentSplitter()
+    for line in lines:
+        document = splitter.feed(line)
+        if document is not None:
+            yield document
+    document = splitter.close()
+    if document is not None:
+        yield document
+
+
+class DocumentSplitter(object):
+    r"""Splits YAML documents as ``split_documents(..)``, line by line
+
+    Each line given to ``.feed(..)`` returns the text of the document
+    it ends, if any, and ``.close()`` returns the text of the last
+    document, if any:
+
+        >>> splitter = DocumentSplitter()
+        >>> [splitter.feed(line) for line in ['a: 1\n', '---\n', 'b\n']]
+        [None, 'a: 1\n', None]
+        >>> splitter.close()
+        '---\nb\n'
+
+    """
+
+    def __init__(self):
+        self.current, self.has_content = [], False
+
+    def feed(self, line):
+        if line[3:4] in MARKER_ENDS:
+            marker = line[:3]
+            if marker in DOCUMENT_START:
+                document = None
+                if self.has_content:
+                    document = line[:0].join(self.current)
+                    self.current = []
+                self.current.append(line)
+                self.has_content = True
+                return document
+            if marker in DOCUMENT_END:
+                document = None
+                if self.has_content:
+                    self.current.append(line)
+                    document = line[:0].join(self.current)
+                self.current, self.has_content = [], False
+                return document
+        self.current.append(line)
+        if not self.has_content:
+            stripped = line.strip()
+            self.has_content = stripped[:1] not in ("", "#", "%",
+                                                    b"", b"#", b"%")
+        return None
+
+    def close(self):
+        if not self.has_content:
+            return None
+        return self.current[0][:0].join(self.current)
+
+
+def batch_documents(documents, size=PARALLEL_BATCH_SIZE):
+    """Yields the concatenation of consecutive ``documents`` by ``size``"""
+    batch, length = [], 0
+    for document in documents:
+        batch.append(document)
+        length += len(document)
+        if length >= size:
+            yield document[:0].join(batch)
+            batch, length = [], 0
+    if batch:
+        yield batch[0][:0].join(batch)
+
+
+def imap_window(pool, fn, args, window):
+    """Same as ``pool.imap(fn, args)``, with ``window`` calls in flight
+
+    ``pool.imap(..)`` consumes ``args`` as fast as it can and keeps
+    results until they are taken, so a big input (or a slow reader of
+    the results) ends up held in memory. Here, a new argument is only
+    submitted when the result of the oldest one is taken.
+
+    """
+    pending = deque()
+    for arg in args:
+        pending.append(pool.apply_async(fn, (arg, )))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def do_batch(args):
+    """Returns outputs of a batch of documents, and the error if any
+
+    This is run in the worker processes of ``do_parallel(..)``.
+
+    """
+    stream, kwargs = args
+    outputs = []
+    try:
+        for output in (do_many(stream, **kwargs) if "queries" in kwargs else
+                       do(stream, **kwargs)):
+            outputs.append(output)
+    except (InvalidPath, InvalidAction, ActionTypeError, InvalidOutput) as e:
+        return outputs, e
+    return outputs, None
+
+
+def do_parallel(stream, jobs, **kwargs):
+    r"""Same as ``do(..)``, with documents processed by ``jobs`` processes
+
+    Or same as ``do_many(..)`` if ``queries`` are given. ``stream`` is
+    split in documents with ``split_documents(..)``, and outputs are
+    yielded in the order of the documents:
+
+        >>> list(do_parallel('a: 1\n---\na: 2\n', 2, action="get-value",
+        ...                  key="a", dump=magic_dump))
+        ['1', '2']
+
+    At most ``PARALLEL_WINDOW`` batches of documents per process are
+    read ahead of the output, so memory use doesn't grow with the size
+    of the input.
+
+    """
+    import multiprocessing
+
+    if isinstance(stream, (bytes, type(u""))):
+        stream = stream.splitlines(True)
+    batches = batch_documents(split_documents(stream))
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(jobs)
+    empty = True
+    try:
+        for outputs, error in imap_window(
+                pool, do_batch, ((batch, kwargs) for batch in batches),
+                PARALLEL_WINDOW * jobs):
+            empty = False
+            for output in outputs:
+                yield output
+            if error is not None:
+                raise error
+    finally:
+        pool.terminate()
+    if empty:
+        ## Empty stream, equivalent to one document having ``null``
+        outputs, error = do_batch(("", kwargs))
+        for output in outputs:
+            yield output
+        if error is not None:
+            raise error
+
+
+def do_file(args):
+    """Returns outputs on a file, and the error if any
+
+    This is run in the worker processes of ``do_files(..)``, errors
+    are returned as exceptions that can be pickled.
+
+    """
+    filename, load, kwargs = args
+    kwargs = dict(kwargs)
+    json_input = kwargs.pop("json_input", False)
+    stats = kwargs.get("stats")
+    try:
+        f = open_input(filename) if load is None else load(filename)
+        stream = f
+        if stats is not None and not isinstance(f, LoadedDocuments):
+            stream = stats.reader(f)
+        if json_input and not isinstance(f, LoadedDocuments):
+            stream = read_json_input(stream, first=kwargs.get("first"))
+    except EnvironmentError as e:
+        return [], InvalidInput("can't read file: %s" % e.strerror)
+    try:
+        return do_batch((stream, kwargs))
+    except yaml.YAMLError as e:
+        return [], InvalidInput("invalid YAML: %s" % e)
+    finally:
+        if load is None:
+            f.close()
+
+
+def do_files(filenames, jobs=1, load=None, **kwargs):
+    r"""Yields ``(filename, outputs, error)`` for each of ``filenames``
+
+    ``outputs`` are the results of ``do(..)`` on the file (or of
+    ``do_many(..)`` if ``queries`` are given), and ``error`` is the
+    exception that stopped its processing, if any. Errors are per
+    file, and don't prevent the processing of the next files:
+
+        >>> for filename, outputs, error in do_files(
+        ...         ["/does/not/exist.yaml"], action="get-type", key=None,
+        ...         default=None, dump=magic_dump):
+        ...     print("%s %r %s" % (filename, outputs, error))
+        /does/not/exist.yaml [] can't read file: No such file or directory
+
+    Files are parsed by ``jobs`` processes (``None`` for one per CPU),
+    results being yielded in the order of ``filenames``. ``load`` is
+    called with each filename to get its YAML stream, and defaults to
+    opening the file.
+
+    """
+    filenames = list(filenames)
+    if jobs == 1:
+        for filename in filenames:
+            outputs, error = do_file((filename, load, kwargs))
+            yield filename, outputs, error
+        return
+
+    import multiprocessing
+
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(jobs)
+    args = ((filename, load, kwargs) for filename in filenames)
+    try:
+        for idx, (outputs, error) in enumerate(
+                imap_window(pool, do_file, args, PARALLEL_WINDOW * jobs)):
+            yield filenames[idx], outputs, error
+    finally:
+        pool.terminate()
+
+
+def main_files(filenames, opts, quiet=False, with_filename=False, jobs=1,
+               load=None, stats=None):
+    """Writes results of ``opts`` on each of ``filenames``
+
+    Each result is terminated by a ``NUL`` char, and preceded by its
+    filename (also ``NUL`` terminated) if ``with_filename`` is set.
+    Errors are reported per file (and per query with ``-e``), and
+    returned exit status is 1 if any file failed. ``stats`` is the
+    ``Stats`` instance accounting the processing, if any.
+
+    """
+    action = opts.get("action", "")
+    if action.endswith("-0"):
+        die("'%s' can't be used with several files, as results are "
+            "already NUL terminated." % action)
+    if stats is not None and jobs == 1:
+        opts = dict(opts, stats=stats)
+    results = do_files(filenames, jobs=jobs, load=load, **opts)
+    if stats is not None:
+        stats.workers = jobs != 1
+        results = stats.timed("load", results)
+        stats.switch("write")
+    status = 0
+    for filename, outputs, error in results:
+        if write_query_outputs(
+                (output if isinstance(output, QUERY_ERRORS) else [output]
+                 for output in outputs),
+                quiet, filename, with_filename):
+            status = 1
+        if error is None:
+            continue
+        if isinstance(error, InvalidAction):
+            die("'%s' is not a valid action.\n%s"
+                % (error.args[0], USAGE))
+        status = 1
+        if not quiet or isinstance(error, (InvalidInput, InvalidOutput)):
+            stderr("Error: %s: %s\n" % (filename, error))
+    return status
+
+
+def read_files0(filename):
+    """Returns the filenames listed, NUL separated, in ``filename``
+
+    ``-`` stands for the standard input.
+
+    """
+    if filename == "-":
+        content = sys.stdin.read()
+    else:
+        with open(filename) as f:
+            content = f.read()
+    return [name for name in content.split("\0") if name]
+
+
+##
+## Stats
+##
+
+STATS_PHASES = ("load", "traverse", "act", "write")
+
+
+class CountingStream(object):
+    """Counts the bytes read from the stream it wraps, for ``Stats``"""
+
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+
+    def count(self, data):
+        self.stats.bytes_read += len(data) if isinstance(data, bytes) else \
+            len(data.encode("utf-8"))
+        return data
+
+    def read(self, size=-1):
+        return self.count(self.stream.read(size))
+
+    def readline(self):
+        return self.count(self.stream.readline())
+
+    def __iter__(self):
+        for line in self.stream:
+            yield self.count(line)
+
+    def close(self):
+        return self.stream.close()
+
+
+class Stats(object):
+    r"""Accounts where time goes while answering a query
+
+    Time is charged to the current phase, which is switched by
+    ``.call(..)`` and ``.timed(..)`` for the duration of a call or of
+    each step of an iteration, so that nested phases are not charged
+    to the enclosing one:
+
+        >>> stats = Stats()
+        >>> list(stats.timed("act", act("get-length", [1, 2])))
+        [2]
+        >>> stats.times["act"] > 0, stats.times["load"]
+        (True, 0.0)
+
+    Counts of documents and of bytes read (through ``.reader(..)``)
+    are kept along.
+
+    """
+
+    def __init__(self):
+        self.clock = getattr(time, "perf_counter", time.time)
+        self.times = dict.fromkeys(STATS_PHASES + ("other", ), 0.0)
+        self.phase = "other"
+        self.start = self.last = self.clock()
+        self.startup = sum(os.times()[:2])  ## CPU time of the process
+        self.documents = 0
+        self.bytes_read = 0
+        self.workers = False  ## set when documents are read elsewhere
+
+    def switch(self, phase):
+        """Charges elapsed time to the current phase, returns it"""
+        now = self.clock()
+        self.times[self.phase] += now - self.last
+        self.last = now
+        previous, self.phase = self.phase, phase
+        return previous
+
+    def call(self, phase, fn, *args, **kwargs):
+        previous = self.switch(phase)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.switch(previous)
+
+    def timed(self, phase, iterable):
+        iterator = iter(iterable)
+        while True:
+            try:
+                value = self.call(phase, next, iterator)
+            except StopIteration:
+                return
+            yield value
+
+    def reader(self, stream):
+        return CountingStream(stream, self)
+
+    def report(self):
+        """Returns the text of the report given by '--stats'"""
+        self.switch(self.phase)
+        total = self.clock() - self.start
+        lines = ["libyaml used: %s" % __with_libyaml__,
+                 "read: %s" % ("%d bytes, %d documents"
+                               % (self.bytes_read, self.documents)
+                               if not self.workers else
+                               "n/a (in worker processes)"),
+                 "startup: %.3fs (CPU time)" % self.startup]
+        lines.extend("%s: %.3fs" % (phase, self.times[phase])
+                     for phase in STATS_PHASES)
+        lines.append("total: %.3fs" % total)
+        peak = peak_memory()
+        lines.append("peak memory: %s" % (
+            "n/a" if peak is None else "%.1f MiB" % (peak / 1048576.0)))
+        return "".join("stats: %s\n" % line for line in lines)
+
+
+def peak_memory():
+    """Returns the peak resident memory of the process in bytes"""
+    try:
+        import resource
+    except ImportError:  ## pragma: no cover
+        return None  ## windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## kilobytes on linux, but bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_profiled(filename, fn, *args):
+    """Calls ``fn(*args)`` and dumps its ``cProfile`` stats to ``filename``
+
+    The file can be read with the ``pstats`` module.
+
+    """
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args)
+    finally:
+        profiler.dump_stats(filename)
+
+
+def main(args, loaded_files=None):
+    """Entrypoint of the whole commandline application
+
+    ``loaded_files`` is used by ``serve(..)`` to answer from its
+    ``ResidentFiles`` instead of reading files or stdin.
+
+    """
+
+    if loaded_files is not None and ("--socket" in args or
+                                     args[:1] == ["serve"]):
+        ## would block the server, or forward to itself
+        die("'%s' can't be forwarded to a server."
+            % ("--socket" if "--socket" in args else "serve"))
+
+    if "--socket" in args:
+        idx = args.index("--socket")
+        if idx + 1 == len(args):
+            die("Missing SOCKET argument to '--socket'.")
+        path = args[idx + 1]
+        return client(args[:idx] + args[idx + 2:], path)
+
+    if args[:1] == ["serve"] and len(args) <= 2:
+        return serve(args[1] if len(args) == 2 else None)
+
+    if args[:1] == ["index"] and len(args) >= 2:
+        return main_index(args[1:])
+
+    if "--profile" in args:
+        idx = args.index("--profile")
+        if idx + 1 == len(args):
+            die("Missing FILE argument to '--profile'.")
+        return run_profiled(args[idx + 1], main,
+                            args[:idx] + args[idx + 2:], loaded_files)
+
+    return main_query(args, loaded_files)
+
+
+def main_query(args, loaded_files=None):
+    """Answers the query of command line ``args``, with '--stats'"""
+    stats = None
+    if "--stats" in args or os.environ.get("SHYAML_STATS"):
+        args = [arg for arg in args if arg != "--stats"]
+        stats = Stats()
+
+    opts = _parse_args(args, USAGE, HELP)
+    if stats is None:
+        return process(opts, loaded_files)
+    try:
+        return process(opts, loaded_files, stats)
+    finally:
+        stderr(stats.report())
+
+
+def process(opts, loaded_files=None, stats=None):
+    """Writes the results of the query of parsed command line ``opts``
+
+    ``loaded_files`` is as in ``main(..)``, and ``stats`` is the
+    ``Stats`` instance accounting the processing, if any. Returns
+    the exit status.
+
+    """
+    quiet = opts.pop("quiet")
+    files0_from = opts.pop("files0_from", None)
+    filenames = input_filenames(opts.pop("filenames", []), files0_from,
+                                opts["with_filename"], loaded_files)
+    if len(filenames) > 1 or files0_from is not None or \
+           opts["with_filename"]:
+        return process_files(filenames, opts, quiet, loaded_files, stats)
+    del opts["with_filename"]
+    filename = filenames[0] if filenames else None
+    line_buffer = "loader" in opts  ## only set by '-L'
+    json_input = opts.pop("json_input")
+    parallel = "jobs" in opts and not opts.get("first")
+
+    if stats is not None:
+        stats.switch("load")  ## reading of the cache or of JSON input
+    source = open_source(filename, loaded_files, opts.pop("cache"))
+    stream = reading_stream(source, filename, parallel, json_input,
+                            opts.get("first"), stats)
+    try:
+        stream, opts["documents"] = select_query_input(
+            stream, filename, opts.pop("documents", None), not json_input,
+            stats)
+        outputs = query_outputs(stream, opts, parallel, stats)
+        if stats is not None:
+            stats.switch("write")
+        status = write_results(outputs, opts, quiet, line_buffer)
+        if (opts.get("first") or opts["documents"] is not None) and \
+               source is sys.stdin:
+            ## Let the writing end of a pipe know we won't read anymore
+            sys.stdin.close()
+    except (InvalidPath, ActionTypeError, MissingDocument) as e:
         if quiet:
             exit(1)
-        else:
-            die(str(e))
+        die(str(e))
+    except InvalidOutput as e:
+        die(str(e))
     except InvalidAction as e:
-        die("'%s' is not a valid action.\n%s"
-            % (e.args[0], USAGE))
+        die("'%s' is not a valid action.\n%s" % (e.args[0], USAGE))
+    return status
+
+
+def input_filenames(filenames, files0_from, with_filename, loaded_files):
+    """Returns the FILEs given with '-f' and '--files0-from'"""
+    if files0_from is not None:
+        if files0_from == "-" and loaded_files is not None:
+            die("server mode can't read '--files0-from' standard input.")
+        try:
+            return filenames + read_files0(files0_from)
+        except EnvironmentError as e:
+            die("can't read %r: %s" % (files0_from, e.strerror))
+    if with_filename and not filenames:
+        die("'-H' requires FILEs given with '-f' or '--files0-from'.")
+    return filenames
+
+
+def process_files(filenames, opts, quiet, loaded_files, stats):
+    """Writes the results of ``opts`` on several ``filenames``"""
+    if opts.pop("documents", None) is not None:
+        die("'--doc' can't be used with several FILEs.")
+    if "queries" in opts:
+        opts["keep_going"] = True
+    parallel = "jobs" in opts
+    jobs = opts.pop("jobs", None)
+    with_filename = opts.pop("with_filename")
+    cache = opts.pop("cache")
+    return main_files(
+        filenames, opts, quiet=quiet, with_filename=with_filename,
+        jobs=1 if loaded_files is not None or not parallel else jobs,
+        load=loaded_files.load if loaded_files is not None else
+        load_all_cached if cache else None, stats=stats)
+
+
+def open_source(filename, loaded_files, cache):
+    """Returns ``filename`` (stdin if ``None``) opened for reading
+
+    The documents are taken from ``loaded_files`` if given, or from
+    the cache if ``cache`` is set.
+
+    """
+    try:
+        if loaded_files is not None:
+            if filename is None:
+                die("server mode requires a FILE given with '-f'.")
+            return loaded_files.load(filename)
+        if cache:
+            return load_all_cached(filename)
+        if filename is not None:
+            return open_input(filename)
+    except EnvironmentError as e:
+        die("can't read %r: %s" % (filename, e.strerror))
+    return sys.stdin
+
+
+def reading_stream(source, filename, binary, json_input, first, stats):
+    """Returns the stream to read YAML documents from ``source``
+
+    The stream reads bytes if ``binary`` is set, accounts for ``stats``
+    if given, and converts JSON to YAML documents if ``json_input``
+    is set.
+
+    """
+    if isinstance(source, LoadedDocuments):
+        return source
+    stream = source
+    if binary and stream is sys.stdin and PY3:
+        stream = sys.stdin.buffer
+    if stats is not None:
+        stream = stats.reader(stream)
+    if not json_input:
+        return stream
+    try:
+        return read_json_input(stream, first=first)
+    except EnvironmentError as e:
+        die("can't read %r: %s" % (filename, e.strerror))
+
+
+def select_query_input(stream, filename, documents, indexed, stats):
+    """Returns ``select_input(..)`` of ``stream``, if ``documents`` given"""
+    if documents is None:
+        return stream, None
+    stream, documents = select_input(stream, filename, documents,
+                                     indexed=indexed)
+    if stats is not None and isinstance(stream, DocumentSlices):
+        stats.bytes_read += sum(len(text) for text in stream)
+    return stream, documents
+
+
+def query_outputs(stream, opts, parallel, stats):
+    """Returns the output chunks of the query, or of each '-e' query
+
+    With queries, the errors of a query are given in place of its
+    output chunks, as with ``do_many(.., keep_going=True)``. Documents
+    are processed by ``opts["jobs"]`` processes if ``parallel`` is set.
+
+    """
+    opts = dict(opts)
+    jobs = opts.pop("jobs", None)
+    if "queries" in opts:
+        opts["keep_going"] = True
+    if parallel and not isinstance(stream, LoadedDocuments):
+        outputs = (output if isinstance(output, QUERY_ERRORS) else [output]
+                   for output in do_parallel(stream, jobs, **opts))
+        if stats is not None:
+            stats.workers = True
+            outputs = stats.timed("load", outputs)
+        return outputs
+    if "queries" in opts:
+        return do_many(stream=stream, chunked=True, stats=stats, **opts)
+    return do(stream=stream, chunked=True, stats=stats, **opts)
+
+
+def write_results(outputs, opts, quiet, line_buffer):
+    """Writes ``outputs`` of ``query_outputs(..)``, returns exit status"""
+    if "queries" in opts:
+        return write_query_outputs(outputs, quiet)
+    write_outputs(outputs, opts["action"], opts["dump"], line_buffer)
+    return 0
+
+
+def write_outputs(outputs, action, dump, line_buffer=False):
+    """Writes the output chunks of each document, with separators"""
+    first = True
+    for chunks in outputs:
+        if first:
+            first = False
+        else:
+            if action not in ACTION_SUPPORTING_STREAMING:
+                die("Source YAML is multi-document, "
+                    "which doesn't support any other action than %s"
+                    % ", ".join(ACTION_SUPPORTING_STREAMING))
+            if dump is yaml_dump:
+                print("---\n", end="")
+            elif dump is not json_dump:
+                print("\0", end="")
+            if line_buffer:
+                sys.stdout.flush()
+
+        safe_write(chunks)
+        if dump is json_dump and action in ACTION_SUPPORTING_STREAMING:
+            print("\n", end="")  ## one JSON line per document
+        sys.stdout.flush()
+
+
+def write_query_outputs(outputs, quiet=False, filename=None,
+                        with_filename=False):
+    """Writes NUL terminated outputs of '-e' queries, returns exit status
+
+    A query that failed gets an empty result, its error being reported
+    on stderr (prefixed by ``filename`` if given) unless ``quiet`` is
+    set. The exit status is then 1. Each result is preceded by
+    ``filename`` (also ``NUL`` terminated) if ``with_filename`` is set.
+
+    """
+    status = 0
+    for chunks in outputs:
+        if with_filename:
+            safe_write([filename, "\0"])
+        if isinstance(chunks, QUERY_ERRORS):
+            status = 1
+            if not quiet or isinstance(chunks, InvalidOutput):
+                sys.stdout.flush()
+                stderr("Error: %s%s\n" % (
+                    "" if filename is None else "%s: " % filename, chunks))
+            chunks = []
+        safe_write(chunks)
+        safe_print("\0")
+    return status
+
+
 ##
 ## Safe print
 ##
@@ -811,20 +3546,295 @@ def main(args):  ## pylint: disable=too-many-branches
 ## Note that locale.getpreferredencoding() does NOT follow
 ## PYTHONIOENCODING by default, but ``sys.stdout.encoding`` does. In
 ## PY2, ``sys.stdout.encoding`` without PYTHONIOENCODING set does not
-## get any values set in subshells.  However, if _preferred_encoding
+## get any values set in subshells.  However, if the preferred encoding
 ## is not set to utf-8, it leads to encoding errors.
-_preferred_encoding = os.environ.get("PYTHONIOENCODING") or \
-                      locale.getpreferredencoding()
+def preferred_encoding():
+    return os.environ.get("PYTHONIOENCODING") or \
+        locale.getpreferredencoding()
+
 
 def safe_print(content):
     if not PY3:
         if isinstance(content, unicode):
-            content = content.encode(_preferred_encoding)
+            content = content.encode(preferred_encoding())
 
     print(content, end='')
     sys.stdout.flush()
 
 
+def safe_write(chunks):
+    """Writes ``chunks`` to stdout as they come, through its buffer
+
+    Contrary to ``safe_print(..)``, stdout is not flushed, which is
+    left to the caller.
+
+    """
+    write = sys.stdout.write
+    encoding = None if PY3 else preferred_encoding()
+    for chunk in chunks:
+        if encoding and isinstance(chunk, unicode):
+            chunk = chunk.encode(encoding)
+        write("%s" % (chunk, ))
+
+
+##
+## Resident server
+##
+
+RESIDENT_MAX_SIZE = 256 * 1024 * 1024
+
+
+class ResidentFiles(object):
+    """Keeps parsed YAML files in memory, reloading them when changed
+
+    When the total size of the files kept grows over ``max_size``
+    bytes, least recently used files are forgotten (the last one
+    loaded is always kept).
+
+    """
+
+    def __init__(self, loader=None, max_size=None):
+        self.loader = loader
+        self.max_size = int(os.environ.get("SHYAML_SERVE_SIZE",
+                                           RESIDENT_MAX_SIZE)) \
+            if max_size is None else max_size
+        self.files = OrderedDict()  ## least recently used first
+        self.size = 0
+
+    def load(self, filename):
+        path = os.path.realpath(filename)
+        st = os.stat(path)
+        signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        entry = self.files.pop(path, None)
+        if entry is not None and entry[0] != signature:
+            self.size -= entry[0][2]
+            entry = None
+        if entry is None:
+            stream = open_input(path)
+            try:
+                entry = (signature, LoadedDocuments(yaml.load_all(
+                    stream, Loader=self.loader or ShyamlSafeLoader)))
+            finally:
+                stream.close()
+            self.size += signature[2]
+        self.files[path] = entry
+        while self.size > self.max_size and len(self.files) > 1:
+            _, (old, _) = self.files.popitem(last=False)
+            self.size -= old[2]
+        return entry[1]
+
+
+def socket_path():
+    """Returns the default unix socket path of ``shyaml serve``"""
+    import tempfile
+
+    return os.environ.get("SHYAML_SOCKET") or \
+        os.path.join(os.environ.get("XDG_RUNTIME_DIR") or
+                     tempfile.gettempdir(),
+                     "shyaml-%s.sock" % getattr(os, "getuid", lambda: 0)())
+
+
+def set_non_blocking(fd):
+    import fcntl
+
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+                os.O_NONBLOCK)
+
+
+## Environment variables of the client applied to the queries it forwards
+FORWARDED_ENV = ("PYTHONIOENCODING", "SHYAML_STATS")
+
+
+def update_environ(values):
+    """Sets environment variables, removing those given as ``None``"""
+    for name, value in values.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+def run_captured(args, cwd, loaded_files, env=None):
+    """Returns exit status, stdout and stderr of command line ``args``
+
+    ``env`` holds the values of ``FORWARDED_ENV`` variables to use,
+    missing ones being unset while running.
+
+    """
+    import traceback
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+
+    env = env or {}
+    saved = sys.stdout, sys.stderr
+    saved_env = dict((name, os.environ.get(name)) for name in FORWARDED_ENV)
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    update_environ(dict((name, env.get(name)) for name in FORWARDED_ENV))
+    try:
+        try:
+            os.chdir(cwd)
+            status = main(list(args), loaded_files=loaded_files)
+        except SystemExit as e:
+            status = e.code
+        except Exception:  ## pylint: disable=broad-except
+            sys.stderr.write(traceback.format_exc())
+            status = 1
+        return status or 0, sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.stdout, sys.stderr = saved
+        update_environ(saved_env)
+
+
+def handle_request(data, loaded_files):
+    """Returns the response to the request ``data`` sent by ``client(..)``
+
+    The command line is run with the environment of the client for
+    ``FORWARDED_ENV``. Its YAML implementation is the one of the
+    server, so the client must use the same one (they differ when only
+    one of them has ``$FORCE_PYTHON_YAML_IMPLEMENTATION`` set):
+
+        >>> import json
+        >>> request = {"args": ["-V"], "cwd": ".", "env": {},
+        ...            "libyaml": not __with_libyaml__}
+        >>> response = json.loads(handle_request(
+        ...     json.dumps(request).encode("utf-8"), None).decode("utf-8"))
+        >>> response["status"], response["stderr"][:32]
+        (1, 'Error: the server and the client')
+
+    """
+    import json
+
+    request = json.loads(data.decode("utf-8"))
+    if request.get("libyaml", __with_libyaml__) != __with_libyaml__:
+        status, out, err = 1, "", (
+            "Error: the server and the client don't use the same YAML "
+            "implementation, check $FORCE_PYTHON_YAML_IMPLEMENTATION.\n")
+    else:
+        status, out, err = run_captured(
+            request["args"], request["cwd"], loaded_files,
+            request.get("env"))
+    return json.dumps({"status": status, "stdout": out, "stderr": err}) \
+        .encode("utf-8")
+
+
+def serve(path=None):
+    """Answers command lines forwarded by ``client(..)`` on a unix socket
+
+    Parsed files are kept in memory, so queries only pay for the
+    traversal and the output of their result.
+
+    """
+    path = path or socket_path()
+    server = listen(path, ResidentFiles())
+    try:
+        accept_requests(server)
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def listen(path, loaded_files):
+    """Returns a server on unix socket ``path`` using ``loaded_files``"""
+    import socket
+    try:
+        import socketserver
+    except ImportError:  ## pragma: no cover
+        import SocketServer as socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            data = self.rfile.read()
+            if data:  ## empty for liveness probes
+                self.wfile.write(handle_request(data, loaded_files))
+
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error:  ## stale socket file
+            os.unlink(path)
+        else:
+            die("a server is already listening on %r." % path)
+        finally:
+            sock.close()
+    umask = os.umask(0o177)  ## no other user can ever connect
+    try:
+        return socketserver.UnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+
+
+def accept_requests(server):
+    """Lets ``server`` handle requests one by one, until stopped
+
+    Signals only ask to stop, so a request being answered is never
+    interrupted, and the wakeup pipe gets the loop out of ``select``.
+
+    """
+    stopping = []
+    wakeup, wakeup_w = os.pipe()
+    for fd in (wakeup, wakeup_w):
+        set_non_blocking(fd)
+    previous_fd = signal.set_wakeup_fd(wakeup_w)
+    previous = dict((signum, signal.signal(
+        signum, lambda signum, frame: stopping.append(signum)))
+                    for signum in (signal.SIGTERM, signal.SIGINT))
+    try:
+        while not stopping:
+            try:
+                ready = select.select([server, wakeup], [], [])[0]
+            except (select.error, OSError):  ## EINTR before python 3.5
+                continue
+            if wakeup in ready:
+                os.read(wakeup, 4096)
+            if server in ready and not stopping:
+                server.handle_request()
+    finally:
+        signal.set_wakeup_fd(previous_fd)
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        os.close(wakeup)
+        os.close(wakeup_w)
+
+
+def client(args, path=None):
+    """Forwards command line ``args`` to a ``shyaml serve`` server
+
+    Returns the exit status of the command line, its output being
+    written on stdout and stderr.
+
+    """
+    import json
+    import socket
+
+    path = path or socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    chunks = []
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({
+            "args": args, "cwd": os.getcwd(), "libyaml": __with_libyaml__,
+            "env": dict((name, os.environ[name]) for name in FORWARDED_ENV
+                        if name in os.environ)}).encode("utf-8"))
+        sock.shutdown(socket.SHUT_WR)
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error as e:
+        die("can't query server on %r: %s" % (path, e))
+    finally:
+        sock.close()
+    if not chunks:
+        die("server on %r stopped without answering." % path)
+    response = json.loads(b"".join(chunks).decode("utf-8"))
+    safe_print(response["stdout"])
+    stderr(response["stderr"])
+    return response["status"]
 
 
 def entrypoint():
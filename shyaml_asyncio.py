@@ -0,0 +1,179 @@
+"""
+asyncio API of shyaml (python >= 3.7).
+"""
+
+## Note: to launch test, you can use:
+##   python -m doctest -d shyaml_asyncio.py
+
+import asyncio
+import functools
+
+import shyaml
+
+
+READ_SIZE = 64 * 1024
+OFFLOAD_SIZE = 64 * 1024  ## documents this big are parsed in an executor
+
+
+async def iter_chunks(source, size=READ_SIZE):
+    """Yields the data of ``source`` as it comes
+
+    ``source`` is an ``asyncio.StreamReader`` (or any object with an
+    awaitable ``.read(size)``), or an async iterable of bytes or str.
+
+    """
+    if hasattr(source, "read"):
+        while True:
+            chunk = await source.read(size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        async for chunk in source:
+            yield chunk
+
+
+async def iter_lines(source):
+    r"""Yields the lines of ``source`` as soon as they are complete
+
+    Lines may span any number of chunks:
+
+        >>> async def chunks():
+        ...     for chunk in ["a: ", "1", "\nb:", " 2\nc", ": 3"]:
+        ...         yield chunk
+        >>> async def lines():
+        ...     return [line async for line in iter_lines(chunks())]
+        >>> asyncio.run(lines())
+        ['a: 1\n', 'b: 2\n', 'c: 3']
+
+    """
+    ## Chunks of the current line are only joined once its end is
+    ## read, and only new chunks are searched for it, so that reading
+    ## a long line stays linear in its size.
+    pending = []
+    async for chunk in iter_chunks(source):
+        newline = b"\n" if isinstance(chunk, bytes) else "\n"
+        end = chunk.find(newline) + 1
+        if not end:
+            pending.append(chunk)
+            continue
+        pending.append(chunk[:end])
+        yield chunk[:0].join(pending)
+        lines = chunk[end:].split(newline)
+        tail = lines.pop()
+        for line in lines:
+            yield line + newline
+        pending = [tail] if tail else []
+    if pending:
+        yield pending[0][:0].join(pending)
+
+
+async def iter_documents(source):
+    """Yields the text of each YAML document of ``source``
+
+    Documents are split as by ``shyaml.split_documents(..)``, and
+    each one is yielded as soon as the line ending it is read.
+
+    """
+    splitter = shyaml.DocumentSplitter()
+    async for line in iter_lines(source):
+        document = splitter.feed(line)
+        if document is not None:
+            yield document
+    document = splitter.close()
+    if document is not None:
+        yield document
+
+
+async def _outputs(source, kwargs, first, executor, offload_size):
+    loop = asyncio.get_running_loop()
+    ## made of module level objects, to be usable by process executors
+    batch = functools.partial(_do_document, kwargs)
+    empty = True
+    async for document in iter_documents(source):
+        empty = False
+        if len(document) >= offload_size:
+            outputs = await loop.run_in_executor(executor, batch, document)
+        else:
+            outputs = batch(document)
+            await asyncio.sleep(0)  ## let other tasks run between documents
+        for output in outputs:
+            yield output
+        if first:
+            return
+    if empty:
+        ## Empty stream, equivalent to one document having ``null``
+        for output in batch(""):
+            yield output
+
+
+def _do_document(kwargs, document):
+    outputs, error = shyaml.do_batch((document, kwargs))
+    if error is not None:
+        raise error
+    return outputs
+
+
+async def do(source, action, key, default=None, dump=shyaml.yaml_dump,
+             loader=None, first=False, executor=None,
+             offload_size=OFFLOAD_SIZE):
+    r"""Yields string representations of target value in ``source`` YAML
+
+    This is the asyncio counterpart of ``shyaml.do(..)``: ``source``
+    is read without blocking the event loop, and the output of each
+    document is yielded as soon as the document is read:
+
+        >>> async def query(data):
+        ...     reader = asyncio.StreamReader()
+        ...     reader.feed_data(data)
+        ...     reader.feed_eof()
+        ...     return [output async for output in
+        ...             do(reader, "get-value", "a", dump=shyaml.magic_dump)]
+        >>> asyncio.run(query(b"a: 1\n---\na: [2]\n"))
+        ['1', '- 2\n']
+
+    Documents of at least ``offload_size`` chars are parsed by
+    ``executor`` (default executor of the loop if ``None``), so that
+    the event loop isn't blocked for long. Smaller ones are parsed in
+    the event loop, which is cheaper. A ``ProcessPoolExecutor`` can be
+    given, to parse big documents on several CPUs.
+
+    :param source:  ``asyncio.StreamReader``, or async iterable of bytes
+                    or str chunks.
+    :param first:   only consider the first YAML document, and stop
+                    reading ``source`` once it is read.
+                    (default is ``False``)
+
+    Other parameters and exceptions are those of ``shyaml.do(..)``.
+
+    """
+    kwargs = dict(action=action, key=key, default=default, dump=dump,
+                  loader=loader, first=first)
+    async for output in _outputs(source, kwargs, first, executor,
+                                 offload_size):
+        yield output
+
+
+async def do_many(source, queries, dump=shyaml.yaml_dump, loader=None,
+                  first=False, executor=None, offload_size=OFFLOAD_SIZE):
+    r"""Yields string representations of several queries on ``source``
+
+    This is the asyncio counterpart of ``shyaml.do_many(..)``, with
+    ``source``, ``executor`` and ``offload_size`` as in ``do(..)``:
+
+        >>> async def chunks():
+        ...     yield b"a: 1\nb: [x, "
+        ...     yield b"y]\n"
+        >>> async def query():
+        ...     return [output async for output in do_many(
+        ...         chunks(), [("get-value", "a", None),
+        ...                    ("get-length", "b", None)],
+        ...         dump=shyaml.magic_dump)]
+        >>> asyncio.run(query())
+        ['1', 2]
+
+    """
+    kwargs = dict(queries=queries, dump=dump, loader=loader, first=first)
+    async for output in _outputs(source, kwargs, first, executor,
+                                 offload_size):
+        yield output